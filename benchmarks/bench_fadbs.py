@@ -0,0 +1,220 @@
+"""
+Benchmark the FADBS plugins against a local stand-in for AniDB
+
+Nothing here talks to the real AniDB. The stand-in serves synthetic anime, or recorded httpapi responses from
+--recordings (files named <aid>.xml), after --latency seconds.
+
+Usage:
+    python -m benchmarks.bench_fadbs --series 100
+    python -m benchmarks.bench_fadbs --series 20000 --latency 0.05 --searches 200 --json bench.json
+
+Every phase reports wall time, per call latency, SQL statements, HTTP requests and peak traced memory. Memory is
+traced with tracemalloc, which slows everything down a bit, so compare runs with each other rather than with
+production.
+Needs FlexGet installed, the same as the plugins themselves.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from .standin import StandinServer, SyntheticCatalog
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Phase(object):
+    """ Measure one phase: per call latency, SQL statements, stand-in requests and peak memory """
+
+    def __init__(self, name, bench):
+        self.name = name
+        self.bench = bench
+        self.latencies = []
+        self.errors = 0
+
+    def __enter__(self):
+        self.sql_start = self.bench.sql_count
+        self.requests_start = self.bench.server.requests
+        tracemalloc.start()
+        self.started = time.perf_counter()
+        return self
+
+    def call(self, func, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception as error:  # pylint: disable=broad-except
+            self.errors += 1
+            if self.errors <= 3:
+                print('  %s failed: %r' % (self.name, error), file=sys.stderr)
+        finally:
+            self.latencies.append(time.perf_counter() - started)
+
+    def __exit__(self, *args):
+        wall = time.perf_counter() - self.started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        latencies = sorted(self.latencies) or [0.0]
+        self.bench.results.append({
+            'phase': self.name,
+            'calls': len(self.latencies),
+            'errors': self.errors,
+            'wall_s': wall,
+            'mean_ms': statistics.mean(latencies) * 1000,
+            'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+            'sql': self.bench.sql_count - self.sql_start,
+            'http': self.bench.server.requests - self.requests_start,
+            'peak_mb': peak / (1024 * 1024)
+        })
+
+
+class Bench(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.results = []
+        self.sql_count = 0
+        self.config_base = tempfile.mkdtemp(prefix='fadbs-bench-')
+        self.catalog = SyntheticCatalog(args.series, seed=args.seed, recordings=args.recordings)
+        self.server = StandinServer(self.catalog, latency=args.latency).start()
+        self.manager = SimpleNamespace(config_base=self.config_base)
+        self._setup_flexget()
+
+    def _setup_flexget(self):
+        """ The bits of a FlexGet manager the plugins use: config_base, a database session and templates """
+        os.makedirs(os.path.join(self.config_base, '.anidb_cache'))
+        shutil.copytree(os.path.join(REPO_ROOT, 'templates'), os.path.join(self.config_base, 'templates'))
+
+        import flexget.logging
+        flexget.logging.initialize(unit_test=True)
+        import flexget.manager
+        # The plugins look the manager up here, for config_base
+        flexget.manager.manager = self.manager
+
+        from sqlalchemy import create_engine, event
+        engine = create_engine('sqlite:///%s' % os.path.join(self.config_base, 'db-bench.sqlite'))
+        event.listen(engine, 'before_cursor_execute', self._count_sql)
+        flexget.manager.Session.configure(bind=engine)
+
+        from flexget.utils import template
+        template.make_environment(self.manager)
+
+        sys.path.insert(0, REPO_ROOT)
+        import fadbs  # noqa pylint: disable=unused-import
+        from fadbs.fadbs_lookup import Base
+        from fadbs.util import anidb
+        Base.metadata.create_all(bind=engine)
+        anidb.AnidbParser.anidb_xml_url = self.server.url + '/httpapi?request=anime&aid=%s'
+        anidb.AnidbSearch.prelook_url = self.server.url + '/?task=search'
+
+    def _count_sql(self, *args):
+        self.sql_count += 1
+
+    def sample(self, count):
+        ids = self.catalog.anime_ids()
+        step = max(1, len(ids) // max(1, count))
+        return ids[::step][:count]
+
+    def run(self):
+        from flexget.entry import Entry
+        from fadbs.fadbs_est_release import EstimateSeriesAniDb
+        from fadbs.fadbs_lookup import FadbsLookup, rebuild_snapshot
+        from fadbs.fadbs_series_nfo import FadbsSeriesNfo
+        from fadbs.util import AnidbSearch
+        from fadbs.util.snapshot import SNAPSHOT_FILE
+
+        lookup = FadbsLookup()
+        entries = []
+        for anidb_id in self.catalog.anime_ids():
+            location = os.path.join(self.config_base, 'library', str(anidb_id))
+            os.makedirs(location)
+            entries.append(Entry(title='Series %s' % anidb_id, url='http://localhost/%s' % anidb_id,
+                                 anidb_id=anidb_id, location=location))
+
+        with Phase('lookup (cold)', self) as phase:
+            for entry in entries:
+                phase.call(lookup.lookup, entry)
+        with Phase('lookup (cached)', self) as phase:
+            for entry in entries:
+                phase.call(lookup.lookup, entry)
+
+        search = AnidbSearch()
+        with Phase('by_name_exact', self) as phase:
+            for anidb_id in self.sample(self.args.searches):
+                phase.call(search.by_name_exact, self.catalog.name(anidb_id))
+
+        estimator = EstimateSeriesAniDb()
+        with Phase('estimate', self) as phase:
+            for anidb_id in self.sample(self.args.estimates):
+                entry = Entry(title=self.catalog.name(anidb_id), url='', series_name=self.catalog.name(anidb_id),
+                              series_id=1)
+                phase.call(estimator.estimate, entry)
+
+        with Phase('snapshot write', self) as phase:
+            phase.call(rebuild_snapshot, os.path.join(self.config_base, SNAPSHOT_FILE))
+        with Phase('estimate (snapshot)', self) as phase:
+            for anidb_id in self.sample(self.args.estimates):
+                entry = Entry(title=self.catalog.name(anidb_id), url='', series_name=self.catalog.name(anidb_id),
+                              series_id=1)
+                phase.call(estimator.estimate, entry)
+
+        nfo = FadbsSeriesNfo()
+        task = SimpleNamespace(name='bench', entries=entries, manager=self.manager)
+        for run in ('first', 'unchanged'):
+            with Phase('series nfo (%s)' % run, self) as phase:
+                phase.call(nfo.on_task_output, task, {'threads': self.args.threads})
+
+    def report(self):
+        columns = ['phase', 'calls', 'errors', 'wall_s', 'mean_ms', 'p50_ms', 'p95_ms', 'sql', 'http', 'peak_mb']
+        print('%d series, %.0fms stand-in latency' % (self.args.series, self.args.latency * 1000))
+        print(''.join(column.rjust(10) if i else column.ljust(20) for i, column in enumerate(columns)))
+        for result in self.results:
+            cells = []
+            for i, column in enumerate(columns):
+                value = result[column]
+                text = '%.2f' % value if isinstance(value, float) else str(value)
+                cells.append(text.rjust(10) if i else text.ljust(20))
+            print(''.join(cells))
+        if self.args.json:
+            with open(self.args.json, 'w') as output:
+                json.dump({'series': self.args.series, 'latency': self.args.latency, 'results': self.results},
+                          output, indent=2)
+
+    def close(self):
+        self.server.stop()
+        if not self.args.keep:
+            shutil.rmtree(self.config_base, ignore_errors=True)
+        else:
+            print('Kept %s' % self.config_base)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark FADBS against a local AniDB stand-in')
+    parser.add_argument('--series', type=int, default=100, help='how many series in the catalog (100 to 20000)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the stand-in waits before answering')
+    parser.add_argument('--searches', type=int, default=50, help='how many by_name_exact calls')
+    parser.add_argument('--estimates', type=int, default=50, help='how many estimate calls')
+    parser.add_argument('--threads', type=int, default=4, help='fadbs_series_nfo writer threads')
+    parser.add_argument('--recordings', help='directory of recorded httpapi responses, named <aid>.xml')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the synthetic catalog')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary config directory')
+    args = parser.parse_args(argv)
+
+    bench = Bench(args)
+    try:
+        bench.run()
+        bench.report()
+    finally:
+        bench.close()
+
+
+if __name__ == '__main__':
+    main()
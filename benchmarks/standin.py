@@ -0,0 +1,194 @@
+""" A local stand-in for the AniDB HTTP API and the anisearch title search, for benchmarking without getting banned """
+import os
+import random
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+SYLLABLES = ['ka', 'ri', 'mo', 'na', 'shi', 'ta', 'ro', 'yu', 'ki', 'ha', 'su', 'me', 'ko', 'to', 'ra', 'zu']
+PARTICLES = ['no', 'wo', 'to', 'ga']
+
+# A few real AniDB tag ids, so the genre split has something to chew on
+TAGS = [
+    (2841, 0, 'action'), (2282, 2841, 'martial arts'), (2850, 0, 'adventure'), (2853, 0, 'comedy'),
+    (2655, 2853, 'parody'), (2849, 0, 'fantasy'), (2648, 2849, 'high fantasy'), (2094, 2849, 'magic'),
+    (2846, 0, 'science fiction'), (2638, 2846, 'mecha'), (2858, 0, 'romance'), (2864, 0, 'daily life'),
+    (2869, 2864, 'school life'), (2881, 0, 'sports'), (3001, 0, 'male protagonist'), (3002, 0, 'female protagonist'),
+    (3003, 0, 'ensemble cast'), (3004, 0, 'time travel'), (3005, 0, 'music')
+]
+
+RELATIONS = ['Sequel', 'Prequel', 'Side Story', 'Alternative Version', 'Summary']
+
+
+class SyntheticCatalog(object):
+    """ Deterministic fake anime, the same seed always gives the same catalog """
+
+    def __init__(self, size, seed=1, recordings=None):
+        self.size = size
+        self.seed = seed
+        self.recordings = recordings
+
+    def anime_ids(self):
+        return list(range(1, self.size + 1))
+
+    def name(self, anidb_id):
+        rand = random.Random(self.seed * 100003 + anidb_id)
+        words = [''.join(rand.choice(SYLLABLES) for _ in range(rand.randint(2, 4))) for _ in range(rand.randint(2, 4))]
+        if rand.random() < 0.4:
+            words.insert(1, rand.choice(PARTICLES))
+        return ' '.join(words).title()
+
+    def recorded(self, anidb_id):
+        if not self.recordings:
+            return None
+        path = os.path.join(self.recordings, '%s.xml' % anidb_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as recording:
+            return recording.read()
+
+    def anime_xml(self, anidb_id):
+        recorded = self.recorded(anidb_id)
+        if recorded is not None:
+            return recorded
+        rand = random.Random(self.seed * 7919 + anidb_id)
+        name = self.name(anidb_id)
+        start = date(1990, 1, 1) + timedelta(days=rand.randint(0, 365 * 30))
+        episode_count = rand.choice([1, 12, 13, 24, 26, 50])
+        parts = [
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<anime id="%s" restricted="false">' % anidb_id,
+            '<type>%s</type>' % rand.choice(['TV Series', 'OVA', 'Movie', 'Web']),
+            '<episodecount>%s</episodecount>' % episode_count,
+            '<startdate>%s</startdate>' % start.isoformat(),
+            '<enddate>%s</enddate>' % (start + timedelta(weeks=episode_count)).isoformat(),
+            '<titles>',
+            '<title xml:lang="x-jat" type="main">%s</title>' % escape(name),
+            '<title xml:lang="en" type="official">%s</title>' % escape(name.upper()),
+            '<title xml:lang="ja" type="official">%s</title>' % escape(name.lower()),
+            '<title xml:lang="x-jat" type="short">%s</title>' % escape(''.join(w[0] for w in name.split())),
+            '</titles>',
+            '<relatedanime>'
+        ]
+        for related_id in rand.sample(range(1, self.size + 1), min(self.size, rand.randint(0, 3))):
+            parts.append('<anime id="%s" type="%s">%s</anime>' % (related_id, rand.choice(RELATIONS),
+                                                                  escape(self.name(related_id))))
+        parts.append('</relatedanime><similaranime>')
+        for similar_id in rand.sample(range(1, self.size + 1), min(self.size, rand.randint(0, 5))):
+            parts.append('<anime id="%s" approval="%s" total="%s">%s</anime>' % (
+                similar_id, rand.randint(1, 20), rand.randint(20, 40), escape(self.name(similar_id))))
+        parts.append('</similaranime>')
+        parts.append('<url>http://example.com/anime/%s</url>' % anidb_id)
+        parts.append('<creators>')
+        for _ in range(rand.randint(3, 10)):
+            creator_id = rand.randint(1, self.size * 3)
+            parts.append('<name id="%s" type="%s">Creator %s</name>' % (
+                creator_id, rand.choice(['Direction', 'Music', 'Animation Work', 'Original Work']), creator_id))
+        parts.append('</creators>')
+        parts.append('<description>%s</description>' % escape(' '.join(
+            self.name(rand.randint(1, self.size)) for _ in range(rand.randint(20, 60)))))
+        parts.append('<ratings><permanent count="%s">%.2f</permanent><temporary count="%s">%.2f</temporary></ratings>'
+                     % (rand.randint(10, 5000), rand.uniform(3, 9.5), rand.randint(10, 5000), rand.uniform(3, 9.5)))
+        parts.append('<tags>')
+        for tag_id, parent_id, tag_name in rand.sample(TAGS, rand.randint(3, len(TAGS))):
+            parent = ' parentid="%s"' % parent_id if parent_id else ''
+            parts.append('<tag id="%s"%s weight="%s" localspoiler="false" globalspoiler="false" verified="true" '
+                         'update="2018-01-01"><name>%s</name><description>About %s.</description></tag>' % (
+                             tag_id, parent, rand.choice([0, 100, 200, 300, 400, 500, 600]), tag_name, tag_name))
+        parts.append('</tags><characters>')
+        for character in range(rand.randint(2, 20)):
+            character_id = anidb_id * 100 + character
+            seiyuu_id = rand.randint(1, self.size * 2)
+            parts.append('<character id="%s" type="%s" update="2018-01-01"><rating votes="%s">%.2f</rating>'
+                         '<name>Character %s</name><gender>%s</gender><charactertype id="1">Character</charactertype>'
+                         '<description>Character %s of %s.</description><seiyuu id="%s">Seiyuu %s</seiyuu></character>'
+                         % (character_id, rand.choice(['main character in', 'secondary cast in', 'appears in']),
+                            rand.randint(1, 100), rand.uniform(1, 10), character_id,
+                            rand.choice(['male', 'female', 'unknown']), character_id, escape(name), seiyuu_id,
+                            seiyuu_id))
+        parts.append('</characters><episodes>')
+        for number in range(1, episode_count + 1):
+            parts.append('<episode id="%s" update="2018-01-01"><epno type="1">%s</epno><length>25</length>'
+                         '<airdate>%s</airdate><rating votes="%s">%.2f</rating>'
+                         '<title xml:lang="en">Episode %s</title><title xml:lang="x-jat">%s</title></episode>'
+                         % (anidb_id * 1000 + number, number, (start + timedelta(weeks=number - 1)).isoformat(),
+                            rand.randint(1, 50), rand.uniform(3, 10), number, escape(self.name(anidb_id + number))))
+        parts.append('</episodes></anime>')
+        return '\n'.join(parts)
+
+    def search_xml(self, query):
+        """ What anisearch answers with, titles starting like the query """
+        query = query.strip("'").replace('~', '').lower()
+        first_word = query.split(' ')[0] if query else ''
+        parts = ['<?xml version="1.0" encoding="UTF-8"?>', '<animetitles>']
+        matches = 0
+        for anidb_id in self.anime_ids():
+            name = self.name(anidb_id)
+            if not name.lower().startswith(first_word):
+                continue
+            parts.append('<anime aid="%s"><title type="main" lang="x-jat" exact="exact"><![CDATA[%s]]></title>'
+                         '</anime>' % (anidb_id, name))
+            matches += 1
+            if matches >= 20:
+                break
+        parts.append('</animetitles>')
+        return '\n'.join(parts)
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """ Answers httpapi?request=anime&aid=... and ?task=search&query=..., after sleeping for the configured latency """
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        query = parse_qs(urlparse(self.path).query)
+        self.server.count_request()
+        if query.get('request') == ['anime'] and 'aid' in query:
+            body = self.server.catalog.anime_xml(int(query['aid'][0]))
+        elif query.get('task') == ['search']:
+            body = self.server.catalog.search_xml(query.get('query', [''])[0])
+        else:
+            self.send_error(404)
+            return
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, catalog, latency=0.0, host='127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), StandinHandler)
+        self.catalog = catalog
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='anidb-standin')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
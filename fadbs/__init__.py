@@ -1,4 +1,7 @@
 """ FADBS """
+from . import fadbs_cli
+from . import fadbs_episode_nfo
 from . import fadbs_est_release
 from . import fadbs_lookup
+from . import fadbs_metrics
 from . import fadbs_series_nfo
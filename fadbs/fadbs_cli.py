@@ -0,0 +1,70 @@
+import os
+
+from flexget import options
+from flexget.event import event
+from flexget.manager import Session
+from flexget.terminal import console
+
+from .fadbs_lookup import import_titles_dump, rebuild_search_index, rebuild_snapshot, search
+from .util.snapshot import SNAPSHOT_FILE
+
+
+def do_cli(manager, options):
+    if options.fadbs_action == 'search':
+        cli_search(options)
+    elif options.fadbs_action == 'reindex':
+        cli_reindex()
+    elif options.fadbs_action == 'snapshot':
+        cli_snapshot(manager)
+    elif options.fadbs_action == 'import-titles':
+        cli_import_titles(options)
+
+
+def cli_search(options):
+    query = ' '.join(options.query)
+    with Session() as session:
+        found = search(query, limit=options.limit, raw=options.raw, session=session)
+        if not found:
+            console('Nothing matches %s' % query)
+            return
+        for series in found:
+            console('%8s  %-60s %s %s' % (series.anidb_id, series.title_main or '', series.series_type or '',
+                                          series.year or ''))
+
+
+def cli_reindex():
+    with Session() as session:
+        indexed = rebuild_search_index(session=session)
+    console('Indexed %s anime' % indexed)
+
+
+def cli_snapshot(manager):
+    with Session() as session:
+        written = rebuild_snapshot(os.path.join(manager.config_base, SNAPSHOT_FILE), session=session)
+    console('Wrote %s anime to the snapshot' % written)
+
+
+def cli_import_titles(options):
+    path = os.path.expanduser(options.path)
+    if not os.path.isfile(path):
+        console('%s does not exist' % path)
+        return
+    with Session() as session:
+        counts = import_titles_dump(path, batch_size=options.batch_size, session=session)
+    console('Read %(anime)s anime, added %(created)s new ones, %(titles)s titles and %(names)s names' % counts)
+
+
+@event('options.register')
+def register_parser_arguments():
+    parser = options.register_command('fadbs', do_cli, help='Query the local AniDB data')
+    subparsers = parser.add_subparsers(title='actions', metavar='<action>', dest='fadbs_action')
+    search_parser = subparsers.add_parser('search', help='Search titles, episode titles, descriptions and tags')
+    search_parser.add_argument('query', nargs='+', help='words to look for')
+    search_parser.add_argument('--limit', type=int, default=20, help='most anime to list (default: %(default)s)')
+    search_parser.add_argument('--raw', action='store_true', help='query is an SQLite FTS5 expression')
+    subparsers.add_parser('reindex', help='Rebuild the search index from the anime already in the database')
+    subparsers.add_parser('snapshot', help='Rebuild the snapshot of titles, tags and airdates')
+    import_parser = subparsers.add_parser('import-titles', help='Load a local copy of AniDB\'s anime-titles dump')
+    import_parser.add_argument('path', help='anime-titles.xml.gz, or the uncompressed xml')
+    import_parser.add_argument('--batch-size', type=int, default=500,
+                               help='anime written per transaction (default: %(default)s)')
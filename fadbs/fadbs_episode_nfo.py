@@ -0,0 +1,191 @@
+import logging
+import os
+import re
+from datetime import datetime
+
+from flexget import db_schema, plugin
+from flexget.event import event
+from flexget.utils import template
+from flexget.utils.database import with_session
+from flexget.utils.pathscrub import pathscrub
+from sqlalchemy import Column, Integer, String, Unicode, DateTime
+from sqlalchemy.orm import subqueryload
+
+from .fadbs_lookup import Anime, AnimeEpisode
+from .util.metrics import metrics
+from .util.nfo_writer import NfoWriter
+from .util.stucture_utils import chunks
+
+PLUGIN_ID = 'fadbs_episode_nfo'
+
+SCHEMA_VER = 1
+
+log = logging.getLogger(PLUGIN_ID)
+
+Base = db_schema.versioned_base(PLUGIN_ID, SCHEMA_VER)
+
+
+class EpisodeNfo(Base):
+    """ What was last written to an episode nfo, so unchanged episodes are not rendered to disk again """
+    __tablename__ = 'fadbs_episode_nfo'
+
+    id = Column(Integer, primary_key=True)
+    path = Column(Unicode, unique=True, index=True)
+    episode_id = Column(Integer, index=True)
+    digest = Column(String)
+    updated = Column(DateTime)
+
+    def __init__(self, path, episode_id, digest):
+        self.path = path
+        self.episode_id = episode_id
+        self.digest = digest
+        self.updated = datetime.utcnow()
+
+
+class FadbsEpisodeNfo(object):
+    """ Write an nfo for every episode AniDB knows about, next to the series' tvshow.nfo """
+
+    schema = {
+        'oneOf': [
+            {'type': 'boolean', 'default': False},
+            {'type': 'object',
+             'properties': {
+                 'filename': {'type': 'string', 'default': '{series} - S{season:02d}E{episode:02d}.nfo'},
+                 'lang': {'type': 'string', 'default': 'en'},
+                 'threads': {'type': 'integer', 'minimum': 1, 'default': 4},
+                 'verify': {'type': 'boolean', 'default': False}}}
+        ]
+    }
+
+    # AniDB epno types, regular episodes are season 1, everything else goes in season 0 after an offset
+    special_offsets = {
+        '2': 0,  # Specials
+        '3': 100,  # Credits
+        '4': 200,  # Trailers
+        '5': 300,  # Parodies
+        '6': 400  # Other
+    }
+
+    digits_regex = re.compile(r'\d+')
+
+    # SQLite refuses more than 999 bound variables
+    query_chunk = 500
+
+    @staticmethod
+    def prepare_config(config):
+        config = {} if isinstance(config, bool) else dict(config)
+        config.setdefault('filename', '{series} - S{season:02d}E{episode:02d}.nfo')
+        config.setdefault('lang', 'en')
+        config.setdefault('threads', 4)
+        config.setdefault('verify', False)
+        return config
+
+    def on_task_output(self, task, config):
+        if config is False:
+            return
+        config = self.prepare_config(config)
+        locations = {}
+        for entry in task.entries:
+            if not entry.get('location') or not entry.get('anidb_id'):
+                log.debug('%s has no location or anidb_id, skipping', entry['title'])
+                continue
+            locations.setdefault(entry['anidb_id'], set()).add(entry['location'])
+        if not locations:
+            return
+        # Compile once, every episode renders from the same template
+        nfo_template = template.get_template('episode.nfo.template')
+        self.__generate(locations, config, nfo_template)
+
+    @with_session
+    def __generate(self, locations, config, nfo_template, session=None):
+        episodes = self.__episodes(locations.keys(), session)
+        known = self.__known_digests(episodes, session)
+        written = []
+        with NfoWriter(max_workers=config['threads']) as writer:
+            for anidb_id, series_title, episode in episodes:
+                context = self.__context(series_title, episode, config['lang'])
+                with metrics.timer('nfo_render'):
+                    content = nfo_template.render(context)
+                digest = writer.digest(content.encode('utf-8'))
+                filename = pathscrub(config['filename'].format(**context), filename=True)
+                for location in locations[anidb_id]:
+                    path = os.path.join(location, filename)
+                    if known.get(path) == digest and (not config['verify'] or os.path.exists(path)):
+                        log.trace('%s has not changed since the last run', path)
+                        continue
+                    writer.submit(path, content,
+                                  lambda done, episode_id=episode.anidb_id, digest=digest:
+                                  written.append((done, episode_id, digest)))
+        unchanged = sum(len(locations[anidb_id]) for anidb_id, _, _ in episodes) - writer.stats['rendered']
+        log.info('%s: %s, %s unchanged since the last run', PLUGIN_ID, writer.summary(), unchanged)
+        for stat in ('written', 'skipped', 'failed'):
+            metrics.count('nfo_%s' % stat, writer.stats[stat])
+        metrics.count('nfo_skipped', unchanged)
+        self.__remember(written, session)
+
+    def __episodes(self, anidb_ids, session):
+        """ Every episode of every series asked for, in a fixed number of queries per chunk of series """
+        episodes = []
+        for anidb_chunk in chunks(anidb_ids, self.query_chunk):
+            series = session.query(Anime).filter(Anime.anidb_id.in_(anidb_chunk)) \
+                .options(subqueryload(Anime.titles),
+                         subqueryload(Anime.episodes).subqueryload(AnimeEpisode.titles)).all()
+            for anime in series:
+                series_title = anime.title_main or str(anime.anidb_id)
+                episodes.extend((anime.anidb_id, series_title, episode) for episode in anime.episodes)
+        return episodes
+
+    def __known_digests(self, episodes, session):
+        known = {}
+        episode_ids = set(episode.anidb_id for _, _, episode in episodes)
+        for episode_chunk in chunks(episode_ids, self.query_chunk):
+            for nfo in session.query(EpisodeNfo).filter(EpisodeNfo.episode_id.in_(episode_chunk)):
+                known[nfo.path] = nfo.digest
+        return known
+
+    @staticmethod
+    def __remember(written, session):
+        for path_chunk in chunks(written, FadbsEpisodeNfo.query_chunk):
+            existing = dict((nfo.path, nfo) for nfo in
+                            session.query(EpisodeNfo).filter(EpisodeNfo.path.in_([path for path, _, _ in path_chunk])))
+            for path, episode_id, digest in path_chunk:
+                nfo = existing.get(path)
+                if nfo is None:
+                    session.add(EpisodeNfo(path, episode_id, digest))
+                    continue
+                nfo.digest = digest
+                nfo.updated = datetime.utcnow()
+
+    def __context(self, series_title, episode, lang):
+        number = self.digits_regex.search(episode.number or '')
+        number = int(number.group()) if number else 0
+        if episode.ep_type in self.special_offsets:
+            season = 0
+            number += self.special_offsets[episode.ep_type]
+        else:
+            season = 1
+        return {
+            'series': series_title,
+            'series_title': series_title,
+            'title': self.__title(episode, lang),
+            'anidb_episode_id': episode.anidb_id,
+            'season': season,
+            'episode': number,
+            'airdate': episode.airdate,
+            'length': episode.length,
+            'rating': episode.rating,
+            'votes': episode.votes
+        }
+
+    @staticmethod
+    def __title(episode, lang):
+        titles = dict((title.language, title.title) for title in episode.titles)
+        for language in (lang, 'en', 'x-jat'):
+            if titles.get(language):
+                return titles[language]
+        return next(iter(titles.values()), episode.number)
+
+
+@event('plugin.register')
+def register_plugin():
+    plugin.register(FadbsEpisodeNfo, PLUGIN_ID, api_ver=2)
@@ -1,14 +1,17 @@
 from __future__ import unicode_literals, division, absolute_import
 
-import difflib
 import logging
+import os
 from builtins import *  # noqa pylint: disable=unused-import, redefined-builtin
+from datetime import datetime
 
 from flexget import plugin
 from flexget.event import event
 from flexget.utils.database import with_session
 
-from .fadbs_lookup import Anime
+from .fadbs_lookup import Anime, AnimeTitle
+from .util.metrics import metrics
+from .util.snapshot import SNAPSHOT_FILE, load_snapshot
 
 PLUGIN_ID = 'fadbs_est_release'
 
@@ -16,26 +19,57 @@ log = logging.getLogger(PLUGIN_ID)
 
 
 class EstimateSeriesAniDb(object):
+
+    @staticmethod
+    def snapshot():
+        from flexget.manager import manager
+        if manager is None:
+            return None
+        return load_snapshot(os.path.join(manager.config_base, SNAPSHOT_FILE))
+
+    @staticmethod
+    def __snapshot_airdate(snapshot, entry):
+        """ The airdate from the snapshot, if it has a title that is exactly the series name """
+        anidb_id = snapshot.find_title(entry['series_name'])
+        if anidb_id is None:
+            return None
+        for number, _, airdate in snapshot.get(anidb_id)['episodes']:
+            try:
+                if int(number) == entry.get('series_id') and airdate:
+                    log.debug('Next airdate from the snapshot: %s', airdate)
+                    return datetime.strptime(airdate, '%Y-%m-%d').date()
+            except ValueError:
+                pass
+        return None
+
     @plugin.priority(2)
+    @metrics.timed('estimate')
     @with_session
     def estimate(self, entry, session=None):
         """ Estimate when the entry episode aired or will air """
         if not all(field in entry for field in ['series_name']):
             log.debug('%s did not have the required attributes to search for the episode', entry['title'])
             return
-        pre_anime = session.query(Anime).join(Anime.titles).all()
-        log.trace('Retrieved %s Anime from the database.', len(pre_anime))
+        snapshot = self.snapshot()
+        if snapshot is not None:
+            airdate = self.__snapshot_airdate(snapshot, entry)
+            if airdate is not None:
+                metrics.count('snapshot_hit')
+                return airdate
+        import difflib
+        # Stubs from the titles dump have no episodes, so there is no airdate to find for them
+        pre_titles = session.query(Anime.anidb_id, AnimeTitle.name).join(Anime.titles) \
+            .filter(Anime.updated.isnot(None)).all()
+        log.trace('Retrieved %s titles from the database.', len(pre_titles))
         titles_match = {}
-        for anime in pre_anime:
-            log.trace('Checking the titles for aid %s', anime.anidb_id)
-            for title in anime.titles:
-                log.trace('Checking title "%s" for aid %s', title.name, anime.anidb_id)
-                compar = difflib.SequenceMatcher(a=entry.get('series_name').lower(), b=title.name.lower()).ratio()
-                if compar >= 0.75:
-                    if anime.anidb_id not in titles_match:
-                        titles_match.update({anime.anidb_id: []})
-                    log.debug('Adding title "%s" to the possible matches.', title.name)
-                    titles_match[anime.anidb_id].append((compar, title.name))
+        for anidb_id, title_name in pre_titles:
+            log.trace('Checking title "%s" for aid %s', title_name, anidb_id)
+            compar = difflib.SequenceMatcher(a=entry.get('series_name').lower(), b=title_name.lower()).ratio()
+            if compar >= 0.75:
+                if anidb_id not in titles_match:
+                    titles_match.update({anidb_id: []})
+                log.debug('Adding title "%s" to the possible matches.', title_name)
+                titles_match[anidb_id].append((compar, title_name))
         if not len(titles_match):
             log.info('There were no title matches found "%s"', entry.get('series_name'))
             return
@@ -1,5 +1,6 @@
 from __future__ import unicode_literals, division, absolute_import
 
+import os
 from builtins import *  # noqa pylint: disable=unused-import, redefined-builtin
 from datetime import datetime
 
@@ -9,28 +10,25 @@ from flexget.db_schema import UpgradeImpossible
 from flexget.event import event
 from flexget.utils.database import with_session
 from flexget.utils.log import log_once
-from sqlalchemy import Table, Column, Integer, Float, String, Unicode, DateTime, Text, Date
-from sqlalchemy.orm import relation, relationship
+from sqlalchemy import Table, Column, Integer, Float, String, Unicode, DateTime, Text, Date, Boolean
+from sqlalchemy import and_, func, literal, select, union
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import relation, relationship, subqueryload
 from sqlalchemy.schema import ForeignKey, Index
 
 from .util import AnidbParser, AnidbSearch
+from .util.locks import LockTimeout, anidb_lock, snapshot_lock
+from .util.metrics import metrics
+from .util.names import normalize_name, parse_release
+from .util.search_index import search_index
+from .util.snapshot import SNAPSHOT_FILE, CatalogSnapshot
+from .util.stucture_utils import chunks
+from .util.titles_dump import iter_titles_dump
 
 SCHEMA_VER = 1
 
 Base = db_schema.versioned_base('fadbs_lookup', SCHEMA_VER)
 
-creators_table = Table('anidb_anime_creators', Base.metadata,
-                       Column('anidb_id', Integer, ForeignKey('anidb_series.id')),
-                       Column('creator_id', Integer, ForeignKey('anidb_creators.id')),
-                       Index('ix_anidb_anime_creators', 'anidb_id', 'creator_id'))
-Base.register_table(creators_table)
-
-# characters_table = Table('anidb_anime_characters', Base.metadata,
-#                          Column('anidb_id', Integer, ForeignKey('anidb_series.id')),
-#                          Column('character_id', Integer, ForeignKey('anidb_characters.id')),
-#                          Index('ix_anidb_anime_characters', 'anidb_id', 'character_id'))
-# Base.register_table(characters_table)
-
 episodes_table = Table('anidb_anime_episodes', Base.metadata,
                        Column('anidb_id', Integer, ForeignKey('anidb_series.id')),
                        Column('episode_id', Integer, ForeignKey('anidb_episodes.id')),
@@ -48,28 +46,54 @@ class AnimeGenreAssociation(Base):
     anidb_id = Column(Integer, ForeignKey('anidb_series.id'), primary_key=True)
     genre_id = Column(Integer, ForeignKey('anidb_genres.id'), primary_key=True)
     genre_weight = Column(Integer)
-    genre = relationship("AnimeGenre")
+    # AniDB ids of the tag's ancestors, closest first and comma separated, as they were when the anime was stored
+    lineage = Column(Unicode)
+    genre = relationship("AnimeGenre", lazy='joined')
+
+    @property
+    def lineage_ids(self):
+        return [int(tag_id) for tag_id in self.lineage.split(',')] if self.lineage else []
+
+
+class AnimeCreatorAssociation(Base):
+    __tablename__ = 'anidb_anime_creators'
+
+    anidb_id = Column(Integer, ForeignKey('anidb_series.id'), primary_key=True)
+    creator_id = Column(Integer, ForeignKey('anidb_creators.id'), primary_key=True)
+    creator_type = Column(Unicode, primary_key=True)
+    creator = relationship('AnimeCreator', lazy='joined')
+
+
+class AnimeCharacterAssociation(Base):
+    __tablename__ = 'anidb_anime_characters'
+
+    anidb_id = Column(Integer, ForeignKey('anidb_series.id'), primary_key=True)
+    character_id = Column(Integer, ForeignKey('anidb_characters.id'), primary_key=True)
+    seiyuu_id = Column(Integer, ForeignKey('anidb_seiyuu.id'), index=True)
+    role = Column(Unicode)
+    character = relationship('AnimeCharacter', lazy='joined')
+    seiyuu = relationship('AnimeSeiyuu', lazy='joined')
 
 
 class Anime(Base):
     __tablename__ = 'anidb_series'
 
     id = Column(Integer, primary_key=True)
-    anidb_id = Column(Integer)
+    anidb_id = Column(Integer, unique=True, index=True)
     series_type = Column(Unicode)
     num_episodes = Column(Integer)
     start_date = Column(Date)
     end_date = Column(Date)
     titles = relation("AnimeTitle")
-    # todo: related anime, many to many?
-    # todo: similar anime, many to many?
+    relations = relationship('AnimeRelation', primaryjoin='Anime.anidb_id == foreign(AnimeRelation.anidb_id)',
+                             viewonly=True)
     url = Column(String)
-    creators = relation("AnimeCreator", secondary=creators_table, backref='series')
+    creators = relationship('AnimeCreatorAssociation', cascade='all, delete-orphan')
     description = Column(Text)
     permanent_rating = Column(Float)
     mean_rating = Column(Float)
     genres = relationship("AnimeGenreAssociation")
-    # characters = relation('AnimeCharacter', secondary=characters_table, backref='series')
+    characters = relationship('AnimeCharacterAssociation', cascade='all, delete-orphan')
     episodes = relation('AnimeEpisode', secondary=episodes_table, backref='series')
     year = Column(Integer)
     season = Column(String)
@@ -97,6 +121,24 @@ class Anime(Base):
         return '<Anime(name=%s,type=%s,year=%s)>' % (self.titles, self.series_type, 0)
 
 
+class AnimeRelation(Base):
+    """ An edge from one anime to a related or similar one, by AniDB id. The other end might not be fetched yet. """
+    __tablename__ = 'anidb_relations'
+    __table_args__ = (Index('ix_anidb_relations_from', 'anidb_id', 'relation_type'),
+                      Index('ix_anidb_relations_to', 'related_id', 'relation_type'))
+
+    id = Column(Integer, primary_key=True)
+    anidb_id = Column(Integer)
+    related_id = Column(Integer)
+    relation_type = Column(Unicode)
+    name = Column(Unicode)
+    approval = Column(Integer)
+    total = Column(Integer)
+
+    def __repr__(self):
+        return '<AnimeRelation(%s -%s-> %s)>' % (self.anidb_id, self.relation_type, self.related_id)
+
+
 class AnimeGenre(Base):
     __tablename__ = 'anidb_genres'
 
@@ -112,17 +154,34 @@ class AnimeGenre(Base):
 
 
 class AnimeCreator(Base):
+    """ A person or company, shared by every anime they worked on. What they did is on the association. """
     __tablename__ = 'anidb_creators'
 
     id = Column(Integer, primary_key=True)
-    anidb_id = Column(Integer)
-    creator_type = Column(Unicode)
+    anidb_id = Column(Integer, unique=True, index=True)
     name = Column(Unicode)
 
-    def __init__(self, anidb_id, creator_type, name):
-        self.anidb_id = anidb_id
-        self.creator_type = creator_type
-        self.name = name
+
+class AnimeCharacter(Base):
+    """ A character, shared by every anime they appear in """
+    __tablename__ = 'anidb_characters'
+
+    id = Column(Integer, primary_key=True)
+    anidb_id = Column(Integer, unique=True, index=True)
+    name = Column(Unicode)
+    gender = Column(Unicode)
+    character_type = Column(Unicode)
+    description = Column(Text)
+    rating = Column(Float)
+
+
+class AnimeSeiyuu(Base):
+    """ A voice actor, shared by every character they voice """
+    __tablename__ = 'anidb_seiyuu'
+
+    id = Column(Integer, primary_key=True)
+    anidb_id = Column(Integer, unique=True, index=True)
+    name = Column(Unicode)
 
 
 class AnimeTitle(Base):
@@ -145,7 +204,7 @@ class AnimeLangauge(Base):
     __tablename__ = 'anidb_languages'
 
     id = Column(Integer, primary_key=True)
-    name = Column(Unicode)
+    name = Column(Unicode, unique=True)
 
     def __init__(self, language):
         self.name = language
@@ -190,6 +249,426 @@ class AnimeEpisodeTitle(Base):
         self.language = langauge
 
 
+class AnidbNegativeResult(Base):
+    """ A name that could not be found, or an id that could not be parsed, so it is not tried again for a while """
+    __tablename__ = 'anidb_negative_cache'
+    __table_args__ = (Index('ix_anidb_negative_cache', 'kind', 'key', unique=True),)
+
+    # How long a miss is remembered for, in seconds
+    ttl = {
+        'name': 3 * 24 * 60 * 60,
+        'id': AnidbParser.RESOURCE_MIN_CACHE
+    }
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(Unicode)
+    key = Column(Unicode)
+    reason = Column(Unicode)
+    added = Column(DateTime)
+
+    def __init__(self, kind, key, reason):
+        self.kind = kind
+        self.key = key
+        self.reason = reason
+        self.added = datetime.utcnow()
+
+    @property
+    def expired(self):
+        return (datetime.utcnow() - self.added).total_seconds() >= self.ttl[self.kind]
+
+    def __repr__(self):
+        return '<AnidbNegativeResult(kind=%s,key=%s,reason=%s)>' % (self.kind, self.key, self.reason)
+
+
+class AnidbNameResolution(Base):
+    """ Which AniDB id a normalized name resolved to, so it is only ever searched for once """
+    __tablename__ = 'anidb_name_resolution'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(Unicode, unique=True, index=True)
+    anidb_id = Column(Integer)
+    score = Column(Float)
+    manual = Column(Boolean, default=False)
+    updated = Column(DateTime)
+
+    def __init__(self, name, anidb_id, score, manual=False):
+        self.name = name
+        self.anidb_id = anidb_id
+        self.score = score
+        self.manual = manual
+        self.updated = datetime.utcnow()
+
+    def __repr__(self):
+        return '<AnidbNameResolution(name=%s,anidb_id=%s,score=%s,manual=%s)>' % (
+            self.name, self.anidb_id, self.score, self.manual)
+
+
+def _add_shared(session, instances, find):
+    """
+    Add rows that another process might be adding at the same time, in a savepoint so a collision only undoes these
+    :param instances: new instances of one model
+    :param find: callable from a new instance to the stored row it collided with
+    :return: the instances, with the stored row in place of each one that collided
+    """
+    if not instances:
+        return []
+    try:
+        with session.begin_nested():
+            session.add_all(instances)
+        return instances
+    except IntegrityError:
+        log.debug('Another process stored some of these %s first', type(instances[0]).__name__)
+    # Once more one at a time, to find out which ones collided
+    stored = []
+    for instance in instances:
+        try:
+            with session.begin_nested():
+                session.add(instance)
+            stored.append(instance)
+        except IntegrityError:
+            metrics.count('insert_race')
+            stored.append(find(instance))
+    return stored
+
+
+def _insert_new(session, table, rows):
+    """
+    Insert rows in one statement, or one at a time skipping the ones another process inserted first
+    :return: how many rows this inserted
+    """
+    if not rows:
+        return 0
+    try:
+        with session.begin_nested():
+            session.execute(table.insert(), rows)
+        return len(rows)
+    except IntegrityError:
+        log.debug('Another process inserted some of these %s rows first', table.name)
+    inserted = 0
+    for row in rows:
+        try:
+            with session.begin_nested():
+                session.execute(table.insert(), row)
+            inserted += 1
+        except IntegrityError:
+            metrics.count('insert_race')
+    return inserted
+
+
+def _get_or_create(session, model, create, **filters):
+    """
+    The row of model matching filters, created if there is none, even when another process is creating it too
+    :param create: callable that makes the new instance
+    """
+    instance = session.query(model).filter_by(**filters).first()
+    if instance is not None:
+        return instance
+    return _add_shared(session, [create()], lambda _: session.query(model).filter_by(**filters).one())[0]
+
+
+def _get_language(session, name):
+    return _get_or_create(session, AnimeLangauge, lambda: AnimeLangauge(name), name=name)
+
+
+@with_session
+def set_name_resolution(name, anidb_id, score=1.0, manual=True, session=None):
+    """
+    Resolve name to anidb_id from now on. A manual resolution is never replaced by a search result.
+    :param name: any spelling of the name, it is normalized
+    :param anidb_id: the AniDB id it should resolve to
+    :return: the AnidbNameResolution
+    """
+    key = normalize_name(name)
+    if not key:
+        raise ValueError('"%s" is empty once normalized' % name)
+    resolution = _get_or_create(session, AnidbNameResolution, lambda: AnidbNameResolution(key, anidb_id, score, manual),
+                                name=key)
+    if manual or not resolution.manual:
+        resolution.anidb_id = anidb_id
+        resolution.score = score
+        resolution.manual = manual
+        resolution.updated = datetime.utcnow()
+    return resolution
+
+
+# relation_type of the edges to similar anime, AniDB's own relation types are capitalized
+SIMILAR_RELATION = 'similar'
+
+# Relations that keep anime in the same franchise, 'Character' and 'Other' are too loose
+FRANCHISE_RELATIONS = ('Sequel', 'Prequel', 'Side Story', 'Parent Story', 'Summary', 'Full Story',
+                       'Alternative Setting', 'Alternative Version', 'Same Setting')
+
+# Far enough for any real chain, and stops a cycle of sequels from going forever
+MAX_CHAIN_DEPTH = 100
+
+
+def _sequel_edges(reverse=False):
+    """ Edges pointing from an anime to its sequel, from both its Sequel and its sequel's Prequel relations """
+    relations = AnimeRelation.__table__
+    source, target = (relations.c.related_id, relations.c.anidb_id) if reverse else \
+        (relations.c.anidb_id, relations.c.related_id)
+    return union(
+        select([source.label('source'), target.label('target')]).where(relations.c.relation_type == 'Sequel'),
+        select([target.label('source'), source.label('target')]).where(relations.c.relation_type == 'Prequel')
+    ).alias('edges')
+
+
+@with_session
+def sequel_chain(anidb_id, prequels=False, session=None):
+    """
+    Every sequel of an anime, sequel first, then its sequel and so on. One recursive query.
+    :param anidb_id: AniDB id to start from
+    :param prequels: follow prequels instead, closest first
+    :return: list of AniDB ids
+    """
+    edges = _sequel_edges(reverse=prequels)
+    chain = select([edges.c.target.label('anidb_id'), literal(1).label('depth')]) \
+        .where(edges.c.source == anidb_id).cte('chain', recursive=True)
+    chain = chain.union_all(select([edges.c.target, chain.c.depth + 1])
+                            .where(and_(edges.c.source == chain.c.anidb_id, chain.c.depth < MAX_CHAIN_DEPTH)))
+    rows = session.query(chain.c.anidb_id, func.min(chain.c.depth).label('depth')) \
+        .group_by(chain.c.anidb_id).order_by('depth').all()
+    return [row.anidb_id for row in rows if row.anidb_id != anidb_id]
+
+
+@with_session
+def franchise(anidb_id, relation_types=FRANCHISE_RELATIONS, session=None):
+    """
+    Every anime connected to an anime through relation_types, in either direction. One recursive query.
+    :param anidb_id: AniDB id of any anime in the franchise
+    :param relation_types: AniDB relation types that count as the same franchise
+    :return: sorted list of AniDB ids, including anidb_id
+    """
+    relations = AnimeRelation.__table__
+    is_franchise = relations.c.relation_type.in_(relation_types)
+    edges = union(
+        select([relations.c.anidb_id.label('source'), relations.c.related_id.label('target')]).where(is_franchise),
+        select([relations.c.related_id.label('source'), relations.c.anidb_id.label('target')]).where(is_franchise)
+    ).alias('edges')
+    members = select([literal(anidb_id).label('anidb_id')]).cte('members', recursive=True)
+    # union, not union_all, so every anime is only visited once and cycles end
+    members = members.union(select([edges.c.target]).where(edges.c.source == members.c.anidb_id))
+    return sorted(row.anidb_id for row in session.query(members.c.anidb_id))
+
+
+def _index_anime(anidb_id, titles, episode_titles, description, tags, session):
+    search_index.update(session, anidb_id, titles=titles, episode_titles=episode_titles, description=description,
+                        tags=tags)
+
+
+@with_session
+def search(query, limit=20, raw=False, session=None):
+    """
+    Search the local titles, episode titles, descriptions and tags
+    :param query: words to look for, the last one may be the start of a word
+    :param limit: most anime to return
+    :param raw: query is an FTS5 expression instead of plain words
+    :return: list of Anime, best match first
+    """
+    ranked = [anidb_id for anidb_id, _ in search_index.search(session, query, limit=limit, raw=raw)]
+    if not ranked:
+        return []
+    found = {series.anidb_id: series for series in
+             session.query(Anime).filter(Anime.anidb_id.in_(ranked)).options(subqueryload(Anime.titles))}
+    return [found[anidb_id] for anidb_id in ranked if anidb_id in found]
+
+
+@with_session
+def tag_lineages(anidb_ids, session=None):
+    """
+    The ancestors of tags, with one recursive query for all of them
+    :param anidb_ids: AniDB ids of the tags
+    :return: dict of tag id to its ancestors' ids, closest first. Tags without a parent are left out.
+    """
+    if not anidb_ids:
+        return {}
+    genres = AnimeGenre.__table__
+    child = genres.alias('child')
+    parent = genres.alias('parent')
+    chain = select([child.c.anidb_id.label('tag_id'), parent.c.anidb_id.label('ancestor_id'),
+                    parent.c.parent_id.label('next_id'), literal(1).label('depth')])\
+        .select_from(child.join(parent, parent.c.id == child.c.parent_id))\
+        .where(child.c.anidb_id.in_(anidb_ids)).cte('chain', recursive=True)
+    ancestor = genres.alias('ancestor')
+    # A cycle in the tag tree repeats until the depth limit, it is cut off below where it first repeats
+    chain = chain.union_all(
+        select([chain.c.tag_id, ancestor.c.anidb_id, ancestor.c.parent_id, chain.c.depth + 1])
+        .select_from(chain.join(ancestor, ancestor.c.id == chain.c.next_id))
+        .where(chain.c.depth < MAX_CHAIN_DEPTH))
+    lineages = {}
+    cycles = set()
+    for row in session.query(chain.c.tag_id, chain.c.ancestor_id).order_by(chain.c.tag_id, chain.c.depth):
+        ancestors = lineages.setdefault(row.tag_id, [])
+        if row.tag_id in cycles or row.ancestor_id in ancestors:
+            cycles.add(row.tag_id)
+            continue
+        ancestors.append(row.ancestor_id)
+    return lineages
+
+
+@with_session
+def rebuild_search_index(session=None):
+    """
+    Index every anime already in the database, for databases from before the index existed
+    :return: how many anime were indexed
+    """
+    search_index.clear(session)
+    anidb_ids = [row.anidb_id for row in session.query(Anime.anidb_id).distinct()]
+    for id_chunk in chunks(anidb_ids, 500):
+        for series in session.query(Anime).filter(Anime.anidb_id.in_(id_chunk))\
+                .options(subqueryload(Anime.titles),
+                         subqueryload(Anime.episodes).subqueryload(AnimeEpisode.titles),
+                         subqueryload(Anime.genres).joinedload(AnimeGenreAssociation.genre)):
+            _index_anime(series.anidb_id, [title.name for title in series.titles],
+                         [title.title for episode in series.episodes for title in episode.titles],
+                         series.description, [genre.genre.name for genre in series.genres], session)
+    session.commit()
+    return len(anidb_ids)
+
+
+def _snapshot_records(session, anidb_ids=None):
+    stored = session.query(Anime.anidb_id).filter(Anime.updated.isnot(None))
+    if anidb_ids is not None:
+        stored = stored.filter(Anime.anidb_id.in_(list(anidb_ids)))
+    anidb_ids = [row.anidb_id for row in stored.distinct()]
+    for id_chunk in chunks(anidb_ids, 500):
+        for series in session.query(Anime).filter(Anime.anidb_id.in_(id_chunk))\
+                .options(subqueryload(Anime.titles), subqueryload(Anime.episodes),
+                         subqueryload(Anime.genres).joinedload(AnimeGenreAssociation.genre)):
+            yield series.anidb_id, {
+                'titles': [[title.name, title.language, title.ep_type] for title in series.titles],
+                'tags': [[genre.genre.name, genre.genre_weight] for genre in series.genres],
+                'episodes': [[episode.number, episode.ep_type, episode.airdate.isoformat() if episode.airdate else None]
+                             for episode in series.episodes]
+            }
+
+
+@with_session
+def rebuild_snapshot(path, session=None):
+    """
+    Write the titles, tags and episode airdates of every anime to a snapshot file
+    :param path: where to write it, see fadbs.util.snapshot
+    :return: how many anime are in it
+    """
+    with snapshot_lock(), metrics.timer('snapshot_write'):
+        return CatalogSnapshot.write(path, _snapshot_records(session))
+
+
+@with_session
+def update_snapshot(path, anidb_ids, session=None):
+    """
+    Rewrite only some anime in the snapshot file, the others are copied over as they are
+    :param anidb_ids: AniDB ids of the anime that changed
+    :return: how many anime are in it
+    """
+    # Read the records under the lock too, so of two processes updating the same anime the newer one writes last
+    with snapshot_lock():
+        records = []
+        for id_chunk in chunks(list(anidb_ids), 500):
+            records.extend(_snapshot_records(session, id_chunk))
+        with metrics.timer('snapshot_update'):
+            return CatalogSnapshot.update(path, records)
+
+
+# Title types from the titles dump that seed name resolution
+SEEDED_TITLE_TYPES = ('main', 'official')
+
+
+def _import_titles_batch(batch, languages, seeded, ambiguous, counts, session):
+    """ Write one batch of the titles dump with a handful of bulk statements, then commit it """
+    anidb_ids = [anidb_id for anidb_id, _ in batch]
+    stored = session.query(Anime.id, Anime.anidb_id, Anime.updated).filter(Anime.anidb_id.in_(anidb_ids)).all()
+    looked_up = set(row.anidb_id for row in stored if row.updated is not None)
+    missing = sorted(set(anidb_ids) - set(row.anidb_id for row in stored))
+    counts['created'] += _insert_new(session, Anime.__table__, [{'anidb_id': anidb_id} for anidb_id in missing])
+    # Anime that were looked up already have every title, only the stubs get theirs from the dump
+    stubs = dict((row.anidb_id, row.id) for row in
+                 session.query(Anime.id, Anime.anidb_id).filter(Anime.anidb_id.in_(anidb_ids), Anime.updated.is_(None))
+                 if row.anidb_id not in looked_up)
+
+    new_languages = set(title['lang'] for anidb_id, titles in batch if anidb_id in stubs
+                        for title in titles if title['lang']) - languages
+    _insert_new(session, AnimeLangauge.__table__, [{'name': language} for language in new_languages])
+    languages.update(new_languages)
+
+    titles_table = AnimeTitle.__table__
+    if stubs:
+        session.execute(titles_table.delete().where(titles_table.c.parent_id.in_(list(stubs.values()))))
+    rows = [{'parent_id': stubs[anidb_id], 'name': title['name'], 'language': title['lang'], 'ep_type': title['type']}
+            for anidb_id, titles in batch if anidb_id in stubs for title in titles]
+    if rows:
+        session.execute(titles_table.insert(), rows)
+        counts['titles'] += len(rows)
+    for anidb_id, titles in batch:
+        if anidb_id in stubs:
+            _index_anime(anidb_id, [title['name'] for title in titles], (), None, (), session)
+
+    # Synonyms and short titles are shared between anime all the time, only main and official ones are seeded.
+    # A name more than one anime has is not seeded at all, and a search with a real score settles it when it comes up.
+    names = {}
+    for anidb_id, titles in batch:
+        for title in titles:
+            if title['type'] not in SEEDED_TITLE_TYPES:
+                continue
+            key = normalize_name(title['name'])
+            if not key or key in ambiguous:
+                continue
+            claimed = names.get(key, seeded.get(key))
+            if claimed is not None and claimed != anidb_id:
+                ambiguous.add(key)
+                names.pop(key, None)
+                continue
+            names[key] = anidb_id
+    for key in [key for key in seeded if key in ambiguous]:
+        # This import seeded it from an earlier batch, before another anime turned up with the same name
+        session.query(AnidbNameResolution).filter(AnidbNameResolution.name == key,
+                                                  AnidbNameResolution.anidb_id == seeded.pop(key),
+                                                  AnidbNameResolution.manual.is_(False))\
+            .delete(synchronize_session=False)
+        counts['names'] -= 1
+    resolved = set()
+    for name_chunk in chunks(list(names), 500):
+        resolved.update(row.name for row in
+                        session.query(AnidbNameResolution.name).filter(AnidbNameResolution.name.in_(name_chunk)))
+    # Whatever is resolved already, by a search or by hand, is left as it is
+    now = datetime.utcnow()
+    new_names = [{'name': name, 'anidb_id': anidb_id, 'score': 1.0, 'manual': False, 'updated': now}
+                 for name, anidb_id in names.items() if name not in resolved and name not in seeded]
+    inserted_names = _insert_new(session, AnidbNameResolution.__table__, new_names)
+    seeded.update((row['name'], row['anidb_id']) for row in new_names)
+    counts['names'] += inserted_names
+    counts['anime'] += len(batch)
+    session.commit()
+    session.expunge_all()
+
+
+@with_session
+def import_titles_dump(path, batch_size=500, session=None):
+    """
+    Load AniDB's anime-titles dump, so names resolve without a search for anime that were never looked up.
+    Anime that are not stored yet get a stub that fadbs_lookup fills in the first time it looks them up.
+    :param path: a local anime-titles.xml.gz, or the uncompressed xml
+    :param batch_size: anime per transaction. Memory use stays at about this many anime, plus the seeded names.
+    :return: dict of how many anime were read, stubs created, titles written and names added
+    """
+    counts = dict.fromkeys(('anime', 'created', 'titles', 'names'), 0)
+    languages = set(row.name for row in session.query(AnimeLangauge.name))
+    # Names this import resolved, and names it found on more than one anime, across every batch
+    seeded = {}
+    ambiguous = set()
+    batch = []
+    with metrics.timer('titles_import'):
+        for item in iter_titles_dump(path):
+            batch.append(item)
+            if len(batch) >= batch_size:
+                _import_titles_batch(batch, languages, seeded, ambiguous, counts, session)
+                log.verbose('Imported %s anime from the titles dump', counts['anime'])
+                batch = []
+        if batch:
+            _import_titles_batch(batch, languages, seeded, ambiguous, counts, session)
+    return counts
+
+
 @db_schema.upgrade('fadbs_lookup')
 def upgrade(ver, session):
     if ver is None:
@@ -218,18 +697,43 @@ class FadbsLookup(object):
         'anidb_startdate': 'start_date',
         'anidb_enddate': 'end_date',
         'anidb_titles': lambda series: FadbsLookup._title_dict(series),
-        # todo: related anime
-        # todo: similar anime
+        'anidb_related': lambda series: dict((relation.related_id, [relation.name, relation.relation_type])
+                                             for relation in series.relations
+                                             if relation.relation_type != SIMILAR_RELATION),
+        'anidb_similar': lambda series: dict((relation.related_id, [relation.name, relation.approval, relation.total])
+                                             for relation in series.relations
+                                             if relation.relation_type == SIMILAR_RELATION),
         'anidb_official_url': 'url',
-        # todo: creators
         'anidb_description': 'description',
         'anidb_rating': 'permanent_rating',
         'anidb_mean_rating': 'mean_rating',
         'anidb_tags': lambda series: dict(
             (genre.genre.anidb_id, [genre.genre.name, genre.genre_weight]) for genre in series.genres),
+        'anidb_tag_lineage': lambda series: dict(
+            (genre.genre.anidb_id, genre.lineage_ids) for genre in series.genres),
         'anidb_episodes': lambda series: dict((episode.anidb_id, episode.number) for episode in series.episodes),
         'anidb_year': 'year',
-        'anidb_season': 'season'}
+        'anidb_season': 'season',
+        'anidb_updated': 'updated'}
+
+    # Only looked up when one of these fields is asked for, so lookups that never use them never load them
+    people_field_map = {
+        'anidb_creators': lambda series: [{
+            'id': association.creator.anidb_id,
+            'name': association.creator.name,
+            'type': association.creator_type
+        } for association in series.creators],
+        'anidb_characters': lambda series: [{
+            'id': association.character.anidb_id,
+            'name': association.character.name,
+            'role': association.role,
+            'gender': association.character.gender,
+            'type': association.character.character_type,
+            'seiyuu': None if association.seiyuu is None else {
+                'id': association.seiyuu.anidb_id,
+                'name': association.seiyuu.name
+            }
+        } for association in series.characters]}
 
     # A tag id with True will remove that tag and all decedents, False just removes that tag
     default_tag_blacklist = {
@@ -253,8 +757,15 @@ class FadbsLookup(object):
         6173: False
     }
 
+    # The AnidbParser sections that get stored, the rest are left unparsed
+    parser_sections = ('titles', 'related', 'similar', 'creators', 'ratings', 'tags', 'characters', 'episodes')
+
     schema = {'type': 'boolean'}
 
+    def __init__(self):
+        # AniDB ids parsed into the database since the snapshot was last updated
+        self.written_ids = set()
+
     @plugin.priority(130)
     def on_task_metainfo(self, task, config):
         if not config:
@@ -263,8 +774,22 @@ class FadbsLookup(object):
             log.debug('Looking up: %s', entry.get('title'))
             self.register_lazy_fields(entry)
 
+    def on_task_exit(self, task, config):
+        if not config or not self.written_ids:
+            return
+        # Only what this process stored, a full rewrite is flexget fadbs snapshot
+        log.verbose('Updating %s anime in the AniDB snapshot', len(self.written_ids))
+        try:
+            update_snapshot(os.path.join(task.manager.config_base, SNAPSHOT_FILE), self.written_ids)
+        except LockTimeout as error:
+            # The database has them, the snapshot just misses them until the next update
+            log.warning('Not updating the AniDB snapshot: %s', error)
+            return
+        self.written_ids = set()
+
     def register_lazy_fields(self, entry):
         entry.register_lazy_func(self.lazy_loader, self.field_map)
+        entry.register_lazy_func(self.lazy_people_loader, self.people_field_map)
 
     def lazy_loader(self, entry):
         try:
@@ -272,6 +797,24 @@ class FadbsLookup(object):
         except plugin.PluginError as err:
             log_once(str(err.value).capitalize(), logger=log)
 
+    def lazy_people_loader(self, entry):
+        try:
+            self.lookup_people(entry)
+        except plugin.PluginError as err:
+            log_once(str(err.value).capitalize(), logger=log)
+
+    @with_session
+    def lookup_people(self, entry, session=None):
+        """ Fill in creators and characters, a query for each, with everyone they point to joined in """
+        anidb_id = entry.get('anidb_id')
+        if not anidb_id:
+            raise plugin.PluginError('anidb_id could not be found, so there are no creators or characters.')
+        series = session.query(Anime).filter(Anime.anidb_id == anidb_id) \
+            .options(subqueryload(Anime.creators), subqueryload(Anime.characters)).first()
+        if series is None:
+            raise plugin.PluginError('AniDB %s is not in the database.' % anidb_id)
+        entry.update_using_map(self.people_field_map, series)
+
     @property
     def series_identifier(self):
         return 'anidb_id'
@@ -281,17 +824,19 @@ class FadbsLookup(object):
     def lookup(self, entry, search_allowed=True, session=None):
         # Try to guarantee we have the AniDB id
         entry_title = entry.get('title', eval_lazy=False)
-        entry_title_extension = entry_title[-4:]
         if entry.get('anidb_id', eval_lazy=False):
             log.debug('The AniDB id is already there, and it is %s', entry['anidb_id'])
         elif entry.get('series_name', eval_lazy=False) and search_allowed:
             log.debug('No AniDB present, searching by series_name.')
-            entry['anidb_id'] = AnidbSearch().by_name_exact(entry['series_name'])
+            entry['anidb_id'] = self.__search(entry['series_name'], session)
             if not entry['anidb_id']:
                 raise plugin.PluginError('The series AniDB id was not found.')
-        elif entry_title and entry_title_extension != '.mkv' and entry_title_extension != '.mp4':
-            log.debug('No AniDB id, no series_name... Attempting title (not promising anything)')
-            entry['anidb_id'] = AnidbSearch().by_name_exact(entry['title'])
+        elif entry_title and parse_release(entry_title).series:
+            # Only the series part of the release goes anywhere near a search, never the group, episode or codec
+            release = parse_release(entry_title)
+            log.debug('No AniDB id, no series_name... Attempting "%s" from the title (not promising anything)',
+                      release.series)
+            entry['anidb_id'] = self.__search(release.series, session)
             if not entry['anidb_id']:
                 raise plugin.PluginError('The series AniDB id was not found :(.')
         else:
@@ -300,8 +845,10 @@ class FadbsLookup(object):
         series = session.query(Anime).filter(Anime.anidb_id == entry['anidb_id']).first()
 
         if series and not series.expired:
+            metrics.count('db_hit')
             entry.update_using_map(self.field_map, series)
             return
+        metrics.count('db_miss' if series is None else 'db_expired')
 
         if series is not None:
             session.commit()
@@ -311,22 +858,91 @@ class FadbsLookup(object):
         # and let the user set it themselves if they want, to
         # a minimum of 24 hours due to AniDB's policies...
 
+        negative = self.__negative_result(session, 'id', entry['anidb_id'])
+        if negative is not None:
+            raise plugin.PluginError('AniDB %s could not be parsed recently (%s), not trying again yet' %
+                                     (entry['anidb_id'], negative.reason))
+
         try:
-            series = self.__parse_new_series(entry['anidb_id'], session)
+            with anidb_lock(entry['anidb_id']):
+                # Another task may have stored it while this one waited for the lock
+                series = session.query(Anime).filter(Anime.anidb_id == entry['anidb_id']).populate_existing().first()
+                if series is not None and not series.expired:
+                    metrics.count('db_hit_after_wait')
+                    entry.update_using_map(self.field_map, series)
+                    return
+                series = self.__parse_new_series(entry['anidb_id'], session, series)
+                # Commit while still holding the lock, so whoever takes it next finds the anime stored
+                session.commit()
+        except LockTimeout as error:
+            raise plugin.PluginError(str(error), log)
+        except IntegrityError:
+            session.rollback()
+            raise plugin.PluginError('AniDB %s was stored by something else at the same time' % entry['anidb_id'], log)
         except UnicodeDecodeError:
             log.error('Unable to determine encoding for %s. Try installing chardet', entry['anidb_id'])
-            series = Anime()
-            series.anidb_id = entry['anidb_id']
-            session.add(series)
-            session.commit()
+            session.rollback()
+            self.__add_negative_result(session, 'id', entry['anidb_id'], 'unknown encoding')
             raise plugin.PluginError('Invalid parameter', log)
         except ValueError:
+            session.rollback()
+            self.__add_negative_result(session, 'id', entry['anidb_id'], 'invalid parameter')
             raise plugin.PluginError('invalid parameter', log)
 
+        self.written_ids.add(entry['anidb_id'])
+
         # todo: trace log attributes?
 
         entry.update_using_map(self.field_map, series)
 
+    def __search(self, name, session):
+        """ Resolve name from earlier searches, or search AniDB unless it was searched for without luck recently """
+        key = normalize_name(name)
+        if not key:
+            log.debug('Nothing is left of "%s" to search for', name)
+            return None
+        resolution = session.query(AnidbNameResolution).filter(AnidbNameResolution.name == key).first()
+        if resolution is not None:
+            metrics.count('resolution_hit')
+            log.debug('"%s" resolved to AniDB %s before', name, resolution.anidb_id)
+            return resolution.anidb_id
+        if self.__negative_result(session, 'name', key) is not None:
+            log.verbose('"%s" was not found on AniDB recently, not searching again yet', name)
+            return None
+        match = AnidbSearch().best_match(name)
+        if not match:
+            self.__add_negative_result(session, 'name', key, 'no search results')
+            return None
+        set_name_resolution(key, match[0], score=match[1], manual=False, session=session)
+        return match[0]
+
+    @staticmethod
+    def __negative_key(kind, key):
+        return normalize_name(key) if kind == 'name' else str(key)
+
+    def __negative_result(self, session, kind, key):
+        """ The unexpired negative result for key, if there is one """
+        negative = session.query(AnidbNegativeResult).filter(AnidbNegativeResult.kind == kind,
+                                                             AnidbNegativeResult.key == self.__negative_key(kind, key))\
+            .first()
+        if negative is None:
+            return None
+        if negative.expired:
+            log.debug('%s has expired, trying again', negative)
+            session.delete(negative)
+            return None
+        metrics.count('negative_cache_hit')
+        return negative
+
+    def __add_negative_result(self, session, kind, key, reason):
+        """ Remember a miss, committing right away since a PluginError usually follows and rolls the session back """
+        key = self.__negative_key(kind, key)
+        negative = _get_or_create(session, AnidbNegativeResult, lambda: AnidbNegativeResult(kind, key, reason),
+                                  kind=kind, key=key)
+        negative.reason = reason
+        negative.added = datetime.utcnow()
+        session.commit()
+
     @staticmethod
     def __query_and_filter(session, what, sql_filter):
         return session.query(what).filter(sql_filter)
@@ -359,10 +975,8 @@ class FadbsLookup(object):
         genres = self.__remove_blacklist(genres)
         genres_list = sorted(genres, key=lambda k: k['parentid'])
         for item in genres_list:
-            genre = self.__query_and_filter(session, AnimeGenre, AnimeGenre.anidb_id == item['id']).first()
-            if not genre:
-                log.debug('%s is not in the genre list, adding', item['name'])
-                genre = AnimeGenre(item['id'], item['name'])
+            genre = _get_or_create(session, AnimeGenre, lambda: AnimeGenre(item['id'], item['name']),
+                                   anidb_id=item['id'])
             if genre.parent_id is None and item['parentid']:
                 parent_genre = \
                     self.__query_and_filter(session, AnimeGenre, AnimeGenre.anidb_id == item['parentid']).first()
@@ -383,65 +997,161 @@ class FadbsLookup(object):
                 number = [item['episode_number'], item['episode_type']]
                 episode = AnimeEpisode(item['id'], number, item['length'], item['airdate'], rating, series.id)
                 for item_title in item['titles']:
-                    lang = self.__query_and_filter(session, AnimeLangauge,
-                                                   AnimeLangauge.name == item_title['lang']).first()
-                    if not lang:
-                        lang = AnimeLangauge(item_title['lang'])
+                    lang = _get_language(session, item_title['lang'])
                     episode.titles.append(AnimeEpisodeTitle(episode.id, item_title['name'], lang.name))
             series.episodes.append(episode)
         return series
 
+    @staticmethod
+    def __add_relations(series, related, similar, session):
+        """ Replace every edge from this anime, in one delete and one bulk insert """
+        session.query(AnimeRelation).filter(AnimeRelation.anidb_id == series.anidb_id)\
+            .delete(synchronize_session=False)
+        edges = [{'anidb_id': series.anidb_id, 'related_id': item['id'], 'relation_type': item['type'],
+                  'name': item['name']} for item in related]
+        edges.extend({'anidb_id': series.anidb_id, 'related_id': item['id'], 'relation_type': SIMILAR_RELATION,
+                      'name': item['name'], 'approval': item['approval'], 'total': item['total']} for item in similar)
+        if edges:
+            session.bulk_insert_mappings(AnimeRelation, edges)
+        return series
+
+    @staticmethod
+    def __upsert_shared(session, model, items):
+        """
+        Bulk upsert entities shared between anime, with one query per chunk to find the ones already stored
+        :param model: AnimeCreator, AnimeCharacter or AnimeSeiyuu
+        :param items: dict of AniDB id to dict of column values
+        :return: dict of AniDB id to entity
+        """
+        entities = {}
+        for id_chunk in chunks(items.keys(), 500):
+            for entity in session.query(model).filter(model.anidb_id.in_(id_chunk)):
+                entities[entity.anidb_id] = entity
+        new = [model(anidb_id=anidb_id, **values) for anidb_id, values in items.items() if anidb_id not in entities]
+        for entity in _add_shared(session, new,
+                                  lambda entity: session.query(model).filter(model.anidb_id == entity.anidb_id).one()):
+            entities[entity.anidb_id] = entity
+        for anidb_id, values in items.items():
+            entity = entities[anidb_id]
+            for column, value in values.items():
+                if getattr(entity, column) != value:
+                    setattr(entity, column, value)
+        return entities
+
+    def __add_creators(self, series, creators, session):
+        shared = self.__upsert_shared(session, AnimeCreator,
+                                      dict((item['id'], {'name': item['name']}) for item in creators))
+        roles = []
+        for item in creators:
+            if (item['id'], item['type']) not in roles:
+                roles.append((item['id'], item['type']))
+        series.creators = [AnimeCreatorAssociation(creator=shared[creator_id], creator_type=creator_type)
+                           for creator_id, creator_type in roles]
+        return series
+
+    def __add_characters(self, series, characters, session):
+        seiyuu = self.__upsert_shared(session, AnimeSeiyuu, dict(
+            (int(item['seiyuu']['id']), {'name': item['seiyuu']['name']})
+            for item in characters if item['seiyuu']['id'] is not None))
+        shared = self.__upsert_shared(session, AnimeCharacter, dict((item['id'], {
+            'name': item['name'],
+            'gender': item['gender'],
+            'character_type': item['character_type']['name'],
+            'description': item['description'],
+            'rating': None if item['rating'] is None else float(item['rating'])
+        }) for item in characters))
+        associations = {}
+        for item in characters:
+            seiyuu_id = item['seiyuu']['id']
+            associations.setdefault(item['id'], AnimeCharacterAssociation(
+                character=shared[item['id']], role=item['type'],
+                seiyuu=None if seiyuu_id is None else seiyuu[int(seiyuu_id)]))
+        series.characters = list(associations.values())
+        return series
+
     def __add_titles(self, series, titles, session):
         for item in titles:
-            lang = session.query(AnimeLangauge).filter(AnimeLangauge.name == item['lang']).first()
-            if not lang:
-                lang = AnimeLangauge(item['lang'])
+            lang = _get_language(session, item['lang'])
             series.titles.append(AnimeTitle(item['name'], lang.name, item['type'], series.id))
         return series
 
-    def __parse_new_series(self, anidb_id, session):
+    @staticmethod
+    def __clear_series(series, session):
+        """ Drop everything a refresh writes again, so the row is reused instead of a second Anime being added """
+        session.query(AnimeTitle).filter(AnimeTitle.parent_id == series.id).delete(synchronize_session=False)
+        for association in (AnimeGenreAssociation, AnimeCreatorAssociation, AnimeCharacterAssociation):
+            session.query(association).filter(association.anidb_id == series.id).delete(synchronize_session=False)
+        session.execute(episodes_table.delete().where(episodes_table.c.anidb_id == series.id))
+        session.expire(series, ['titles', 'genres', 'creators', 'characters', 'episodes'])
+
+    def __parse_new_series(self, anidb_id, session, series=None):
+        """
+        Fetch and store an anime
+        :param series: the Anime already stored for anidb_id, an expired one or a stub from the titles dump
+        """
 
         def __debug_parse(what):
             log.debug('Parsing %s for AniDB %s', what, anidb_id)
 
-        parser = AnidbParser(anidb_id)
+        parser = AnidbParser(anidb_id, sections=self.parser_sections)
         log.verbose('Starting to parse AniDB %s', anidb_id)
         parser.parse()
 
         log.debug('Parsed AniDB %s', anidb_id)
-        log.debug('Populating the Anime')
-        series = Anime()
-        series.anidb_id = anidb_id
-        series.series_type = parser.type
-        series.num_episodes = parser.num_episodes
-        series.start_date = parser.dates['start']
-        series.year = parser.year
-        # todo: make this better
-        try:
-            series.end_date = parser.dates['end']
-        except KeyError:
-            pass
-        # end
-        series.url = parser.official_url
-        series.description = parser.description
-        if parser.ratings:
-            permanent_rating = parser.ratings['permanent']
-            series.permanent_rating = None if permanent_rating is None else permanent_rating['rating']
-            mean_rating = parser.ratings['mean']
-            series.mean_rating = None if mean_rating is None else mean_rating['rating']
-
-        __debug_parse('genres')
-        series = self.__add_genres(series, parser.genres, session)
-
-        __debug_parse('episodes')
-        series = self.__add_episodes(series, parser.episodes, session)
-
-        __debug_parse('titles')
-        series = self.__add_titles(series, parser.titles, session)
-
-        series.updated = datetime.utcnow()
-
-        session.add(series)
+        with metrics.timer('db_write'):
+            log.debug('Populating the Anime')
+            if series is None:
+                series = Anime()
+                series.anidb_id = anidb_id
+            else:
+                self.__clear_series(series, session)
+            series.series_type = parser.type
+            series.num_episodes = parser.num_episodes
+            series.start_date = parser.dates['start']
+            series.year = parser.year
+            # todo: make this better
+            try:
+                series.end_date = parser.dates['end']
+            except KeyError:
+                pass
+            # end
+            series.url = parser.official_url
+            series.description = parser.description
+            if parser.ratings:
+                permanent_rating = parser.ratings['permanent']
+                series.permanent_rating = None if permanent_rating is None else permanent_rating['rating']
+                mean_rating = parser.ratings['mean']
+                series.mean_rating = None if mean_rating is None else mean_rating['rating']
+
+            __debug_parse('genres')
+            series = self.__add_genres(series, parser.genres, session)
+            lineages = tag_lineages([association.genre.anidb_id for association in series.genres], session=session)
+            for association in series.genres:
+                association.lineage = ','.join(str(tag_id) for tag_id in lineages.get(association.genre.anidb_id, ()))
+
+            __debug_parse('episodes')
+            series = self.__add_episodes(series, parser.episodes, session)
+
+            __debug_parse('titles')
+            series = self.__add_titles(series, parser.titles, session)
+
+            __debug_parse('creators')
+            series = self.__add_creators(series, parser.creators, session)
+
+            __debug_parse('characters')
+            series = self.__add_characters(series, parser.characters, session)
+
+            __debug_parse('relations')
+            series = self.__add_relations(series, parser.related_anime, parser.similar_anime, session)
+
+            __debug_parse('search index')
+            _index_anime(anidb_id, [item['name'] for item in parser.titles],
+                         [title['name'] for item in parser.episodes for title in item['titles']],
+                         parser.description, [item['name'] for item in parser.genres], session)
+
+            series.updated = datetime.utcnow()
+
+            session.add(series)
 
         return series
 
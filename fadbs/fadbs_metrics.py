@@ -0,0 +1,86 @@
+import logging
+import os
+
+from flexget import plugin
+from flexget.event import event
+
+from .util.metrics import metrics
+
+PLUGIN_ID = 'fadbs_metrics'
+
+log = logging.getLogger(PLUGIN_ID)
+
+
+class FadbsMetrics(object):
+    """
+    Time the hot paths of the FADBS plugins for one task, log a summary when the task is done,
+    and optionally write them out for monitoring.
+
+    Example:
+      fadbs_metrics:
+        file: metrics/{task}.prom
+        format: prometheus
+    """
+
+    schema = {
+        'oneOf': [
+            {'type': 'boolean'},
+            {'type': 'object',
+             'properties': {
+                 'file': {'type': 'string'},
+                 'format': {'type': 'string', 'enum': ['json', 'prometheus'], 'default': 'json'}},
+             'additionalProperties': False}
+        ]
+    }
+
+    @staticmethod
+    def prepare_config(config):
+        config = {} if isinstance(config, bool) else dict(config)
+        config.setdefault('format', 'json')
+        return config
+
+    @plugin.priority(255)
+    def on_task_start(self, task, config):
+        if config is False:
+            return
+        metrics.reset()
+
+    @plugin.priority(-255)
+    def on_task_exit(self, task, config):
+        if config is False:
+            return
+        config = self.prepare_config(config)
+        lines = metrics.summary()
+        if not lines:
+            log.verbose('Nothing was measured for %s', task.name)
+            return
+        log.info('FADBS metrics for %s:', task.name)
+        for line in lines:
+            log.info('  %s', line)
+        if config.get('file'):
+            self.__export(task, config)
+
+    on_task_abort = on_task_exit
+
+    @staticmethod
+    def __export(task, config):
+        path = os.path.expanduser(config['file'].replace('{task}', task.name))
+        path = os.path.join(task.manager.config_base, path)
+        if config['format'] == 'prometheus':
+            content = metrics.to_prometheus(labels={'task': task.name})
+        else:
+            content = metrics.to_json(task=task.name)
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as export:
+            export.write(content)
+        # Replace, so a scraper never reads half a file
+        os.replace(temp_path, path)
+        log.debug('Wrote metrics for %s to %s', task.name, path)
+
+
+@event('plugin.register')
+def register_plugin():
+    plugin.register(FadbsMetrics, PLUGIN_ID, api_ver=2)
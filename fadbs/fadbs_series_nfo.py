@@ -5,6 +5,9 @@ from flexget import plugin
 from flexget.event import event
 from flexget.utils import template
 
+from .util.genres import GenreClassifier
+from .util.metrics import metrics
+from .util.nfo_writer import NfoWriter
 from .util.stucture_utils import find_in_list_of_dict
 
 PLUGIN_ID = 'fadbs_series_nfo'
@@ -20,6 +23,7 @@ class FadbsSeriesNfo(object):
             {'type': 'object',
              'properties': {
                  'genre_weight': {'type': 'integer', 'default': 500},
+                 'threads': {'type': 'integer', 'minimum': 1, 'default': 4},
                  'spoilers': {'type': 'array',
                               'items': {'type': 'string', 'enum': ['local', 'global']}},
                  'title': {'type': 'object',
@@ -33,7 +37,7 @@ class FadbsSeriesNfo(object):
     # These are all genres, genres that are True don't have possible overriding sub-genres
     # Genres that are False have possible overriding sub-genres
     # genres with another genre id replace that genre as a genre (if that makes sense)
-    # todo: Make this more flexible, what if someone wants a sub-sub-genre to be a genre?
+    # Tags descending from a replacing genre replace the same genre, see GenreClassifier
     default_genres = {
         2841: True, 2282: True,  # Action and martial arts
         2850: True,  # Adventure
@@ -50,9 +54,32 @@ class FadbsSeriesNfo(object):
         2881: True  # Sports
     }
 
+    # Overrides are resolved once, and every series is split once per genre_weight
+    genre_classifier = GenreClassifier(default_genres)
+
+    @staticmethod
+    def prepare_config(config):
+        config = {} if isinstance(config, bool) else dict(config)
+        config.setdefault('genre_weight', 500)
+        config.setdefault('threads', 4)
+        return config
+
     def on_task_output(self, task, config):
+        if config is False:
+            return
         log.info('Starting fadbs_series_nfo')
+        config = self.prepare_config(config)
         filename = os.path.expanduser('tvshow.nfo.template')
+        # Compile once, every entry renders from the same template
+        nfo_template = template.get_template(filename)
+        # Rendering touches lazy fields and the database, so it stays here. Only the file writes are threaded.
+        with NfoWriter(max_workers=config['threads']) as writer:
+            self.__render_entries(task, config, nfo_template, writer)
+        log.info('fadbs_series_nfo: %s', writer.summary())
+        for stat in ('written', 'skipped', 'failed'):
+            metrics.count('nfo_%s' % stat, writer.stats[stat])
+
+    def __render_entries(self, task, config, nfo_template, writer):
         for entry in task.entries:
             log.debug('Starting nfo generation for %s', entry['title'])
             # Load stuff
@@ -67,26 +94,14 @@ class FadbsSeriesNfo(object):
             entry['fadbs_nfo']['genres'] = []
             entry['fadbs_nfo']['tags'] = []
             if entry_tags:
-                fadbs_nfo = self.__genres(entry.get('anidb_tags').items(), config['genre_weight'])
+                fadbs_nfo = self.genre_classifier.classify(entry_tags, entry.get('anidb_tag_lineage') or {},
+                                                           config['genre_weight'])
                 entry['fadbs_nfo'].update(genres=fadbs_nfo[0])
                 entry['fadbs_nfo'].update(tags=fadbs_nfo[1])
-            template_ = template.render_from_entry(template.get_template(filename), entry)
+            with metrics.timer('nfo_render'):
+                template_ = template.render_from_entry(nfo_template, entry)
             nfo_path = os.path.join(entry['location'], 'tvshow.nfo')
-            with open(nfo_path, 'wb') as nfo:
-                nfo.write(template_.encode('utf-8'))
-                nfo.close()
-
-    def __genres(self, anidb_tags, genre_weight):
-        genres = []
-        tags = []
-        for aid, info in anidb_tags:
-            log.trace('%s: %s, weight %s', aid, info[0], info[1])
-            if aid in self.default_genres or info[1] >= genre_weight:
-                genres.append(info[0])
-                # todo: remove an overridden genre
-                continue
-            tags.append(info[0])
-        return genres, tags
+            writer.submit(nfo_path, template_)
 
     @staticmethod
     def __main_title(config, titles):
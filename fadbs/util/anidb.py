@@ -1,19 +1,18 @@
 from __future__ import unicode_literals, division, absolute_import
 
-import hashlib
-import os
 import re
-import difflib
 from builtins import *  # noqa pylint: disable=unused-import, redefined-builtin
 from datetime import datetime
-from bs4 import Tag
 from flexget import logging
 from flexget import plugin
 from flexget.utils.requests import Session, TimedLimiter
-from flexget.utils.soup import get_soup
-from slugify import slugify
 
-from .anidb_cache import cached_anidb, ANIDB_CACHE
+from .anidb_cache import cached_anidb, write_cache
+from .locks import ANIDB_API_HOST, anidb_api_slot
+from .metrics import metrics
+from .names import PARTICLE_WORDS, particle_search_terms
+
+# bs4 and difflib are imported where they are used, so runs that never fetch or search do not pay for them
 
 PLUGIN_ID = 'fadbs.util.anidb'
 
@@ -25,7 +24,7 @@ log = logging.getLogger(PLUGIN_ID)
 requests = Session()
 requests.headers.update({'User-Agent': 'Python-urllib/2.6'})
 
-requests.add_domain_limiter(TimedLimiter('api.anidb.net', '2 seconds'))
+requests.add_domain_limiter(TimedLimiter(ANIDB_API_HOST, '2 seconds'))
 
 
 class AnidbSearch(object):
@@ -34,16 +33,13 @@ class AnidbSearch(object):
     anidb_xml_url = 'http://api.anidb.net:9001/httpapi?request=anime'
     prelook_url = 'http://anisearch.outrance.pl?task=search'
     cdata_regex = re.compile(r'.+CDATA\[(.+)\]\].+')
-    particle_words = {
-        'x-jat': {
-            'no', 'wo', 'o', 'na', 'ja', 'ni', 'to', 'ga', 'wa'
-        }
-    }
+    particle_words = PARTICLE_WORDS
 
     def __init__(self):
         self.debug = False
 
     def __get_title_comparisons(self, original_title, anime_objects, min_ratio=0.65):
+        import difflib
         titles = []
         for anime in anime_objects:
             aid = anime['aid']
@@ -65,30 +61,42 @@ class AnidbSearch(object):
         log.verbose('Returning %s titles with at least %s similarity.', len(titles), min_ratio)
         return titles
 
-    def by_name_exact(self, anime_name):
+    @metrics.timed('search')
+    def best_match(self, anime_name):
         """
-        Search for an anime by exact name, not terribly friendly right now
+        Search for an anime by name, and pick the closest title
 
         :param anime_name: name of the anime
-        :return: an anidb id, hopefully
+        :return: list of anidb id, similarity ratio and the matching title, or None
         """
-        name_parts = slugify(anime_name).split('-')
-        name_parts = ['~' + part if part in self.particle_words['x-jat'] else part for part in name_parts]
-        anime_name_mod = ' '.join(name_parts)
+        anime_name_mod = ' '.join(particle_search_terms(anime_name))
         search_url = self.prelook_url + "&query='%s'" % anime_name_mod
-        print(search_url)
-        req = requests.get(search_url)
+        log.debug('Searching: %s', search_url)
+        with metrics.timer('search_fetch'):
+            req = requests.get(search_url)
         if req.status_code != 200:
             raise Exception
-        soup = get_soup(req.text)
-        matches = self.__get_title_comparisons(anime_name, soup.find_all('anime'))
+        with metrics.timer('search_compare'):
+            from flexget.utils.soup import get_soup
+            soup = get_soup(req.text)
+            matches = self.__get_title_comparisons(anime_name, soup.find_all('anime'))
         if not len(matches):
             return None
         matches.sort(key=lambda x: x[1], reverse=True)
-        if matches[0][1] > 1:
+        if matches[0][1] < 1:
             log.warning('Results for "%s" did not return an exact match. Choosing best match, "%s"',
                         anime_name, matches[0][2])
-        return matches[0][0]
+        return [int(matches[0][0]), matches[0][1], matches[0][2]]
+
+    def by_name_exact(self, anime_name):
+        """
+        Search for an anime by exact name, not terribly friendly right now
+
+        :param anime_name: name of the anime
+        :return: an anidb id, hopefully
+        """
+        match = self.best_match(anime_name)
+        return None if match is None else match[0]
 
 
 class AnidbParser(object):
@@ -107,23 +115,60 @@ class AnidbParser(object):
         ('Fall', range(10, 13))
     }
 
-    def __init__(self, anidb_id):
+    # Sections that can be skipped, and the root level tag each one lives in
+    section_tags = {
+        'titles': 'titles',
+        'related': 'relatedanime',
+        'similar': 'similaranime',
+        'creators': 'creators',
+        'ratings': 'ratings',
+        'tags': 'tags',
+        'characters': 'characters',
+        'episodes': 'episodes'
+    }
+
+    # Attributes filled by a section, and their value when the section is empty
+    section_attributes = {
+        'titles': {'titles': list},
+        'related': {'related_anime': list},
+        'similar': {'similar_anime': list},
+        'creators': {'creators': list},
+        'ratings': {'ratings': lambda: None},
+        'tags': {'genres': list},
+        'characters': {'characters': list},
+        'episodes': {'episodes': list}
+    }
+
+    # Cheap root level tags that are always parsed
+    base_tags = ['type', 'episodecount', 'startdate', 'enddate', 'url', 'description']
+
+    def __init__(self, anidb_id, sections=None):
+        """
+        :param anidb_id: the AniDB id of the anime
+        :param sections: the sections to parse up front, everything if None. Anything else is parsed on first access.
+        """
         self.anidb_id = anidb_id
+        self.sections = set(self.section_tags) if sections is None else set(sections)
+        unknown_sections = self.sections - set(self.section_tags)
+        if unknown_sections:
+            raise ValueError('Unknown AniDB sections: %s' % ', '.join(sorted(unknown_sections)))
         self.type = None  # type
         self.num_episodes = None  # episodecount
         self.dates = {}  # startdate, enddate
-        self.titles = []  # titles > title
-        self.related_anime = []  # relatedanime
-        self.similar_anime = []  # similaranime
         self.official_url = None  # url
-        self.creators = []  # creators
         self.description = None  # description
-        self.ratings = None
-        self.genres = []  # tags
-        self.characters = []  # characters
-        self.episodes = []  # episodes
         self.year = None
         self.season = None
+        self._page = None
+        self._parsed_sections = set()
+
+    def __getattr__(self, name):
+        # Only called when the attribute is missing, which means it belongs to a section that has not been parsed yet
+        for section, attributes in self.section_attributes.items():
+            if name in attributes:
+                self.__parse_section(section)
+                return self.__dict__[name]
+        raise AttributeError('%s has no attribute %s' % (type(self).__name__, name))
 
     def __str__(self):
         return '<AnidbParser (name=%s, anidb_id=%s)>' % ('WIP', self.anidb_id)
@@ -145,8 +190,8 @@ class AnidbParser(object):
     def __append_similar(self, similar):
         self.similar_anime.append({
             'id': int(similar['id']),
-            'approval': similar['approval'],
-            'total': similar['total'],
+            'approval': int(similar['approval']),
+            'total': int(similar['total']),
             'name': similar.string
         })
 
@@ -173,11 +218,14 @@ class AnidbParser(object):
         seiyuu = character.find('seiyuu')
         rating = character.find('rating')
         description = character.find('description')
+        name = character.find('name')
+        gender = character.find('gender')
         self.characters.append({
             'id': int(character['id']),
+            'name': None if name is None else name.string,
             'type': character['type'],
             'rating': None if rating is None else rating.string,
-            'gender': character.find('gender').string,
+            'gender': None if gender is None else gender.string,
             'character_type': {
                 'id': character_type['id'],
                 'name': character_type.string
@@ -191,6 +239,7 @@ class AnidbParser(object):
 
     @staticmethod
     def __find_episode_titles(ep_titles_contents):
+        from bs4 import Tag
         titles = []
         for title in ep_titles_contents:
             if isinstance(title, Tag):
@@ -241,47 +290,92 @@ class AnidbParser(object):
             else:
                 self.dates['end'] = None
 
-    def __set_sim_rel(self, similar_tag, related_tag):
-        if similar_tag is not None:
-            self.__parse_tiered_tag(similar_tag, self.__append_similar)
+    def __set_ratings(self, ratings_tag):
+        if ratings_tag is None:
+            return
+        permanent_tag = ratings_tag.find('permanent')
+        mean_tag = ratings_tag.find('temporary')
+        self.ratings = {
+            'permanent': {
+                'rating': permanent_tag.string,
+                'votes': permanent_tag['count']
+            },
+            'mean': {
+                'rating': mean_tag.string,
+                'votes': mean_tag['count']
+            }
+        }
+
+    def __section_handlers(self):
+        return {
+            'titles': self.__append_title,
+            'related': self.__append_related,
+            'similar': self.__append_similar,
+            'creators': self.__append_creator,
+            'tags': self.__append_genre,
+            'characters': self.__append_character,
+            'episodes': self.__append_episode
+        }
+
+    def __get_soup(self, tags):
+        """ Build a soup out of the retained page, keeping only the given tags """
+        from bs4 import BeautifulSoup, SoupStrainer
+        return BeautifulSoup(self._page, 'lxml', parse_only=SoupStrainer(tags))
 
-        if related_tag is not None:
-            self.__parse_tiered_tag(related_tag, self.__append_related)
+    def __parse_section(self, section, soup=None):
+        if section in self._parsed_sections:
+            return
+        self._parsed_sections.add(section)
+        for attribute, default in self.section_attributes[section].items():
+            setattr(self, attribute, default())
+        if soup is None:
+            if self._page is None:
+                log.debug('%s has no page to parse %s from', self, section)
+                return
+            log.trace('Lazily parsing %s for AniDB %s', section, self.anidb_id)
+            metrics.count('parse_lazy_section')
+            with metrics.timer('parse'):
+                soup = self.__get_soup(self.section_tags[section])
+                self.__parse_section_tag(section, soup)
+            return
+        self.__parse_section_tag(section, soup)
+
+    def __parse_section_tag(self, section, soup):
+        section_tag = soup.find(self.section_tags[section])
+        if section_tag is None:
+            return
+        if section == 'ratings':
+            self.__set_ratings(section_tag)
+        else:
+            self.__parse_tiered_tag(section_tag, self.__section_handlers()[section])
 
     @cached_anidb
-    def parse(self, soup=None):
+    def parse(self, page=None):
 
-        if not soup:
-            pre_cache_name = ('anime: %s' % self.anidb_id).encode()
+        if not page:
             url = (self.anidb_xml_url + "&client=%s&clientver=%s&protover=1") % (self.anidb_id, CLIENT_STR, CLIENT_VER)
             log.debug('Not in cache. Looking up URL: %s', url)
-            page = requests.get(url)
-            page = page.text
-            # todo: move this to cached_anidb
-            from flexget.manager import manager
-            if 'blake2b' in hashlib.algorithms_available:
-                blake = hashlib.new('blake2b')
-                blake.update(pre_cache_name)
-                cache_filename = os.path.join(manager.config_base, ANIDB_CACHE, blake.hexdigest())
-            else:
-                md5sum = hashlib.md5(pre_cache_name).hexdigest()
-                cache_filename = os.path.join(manager.config_base, ANIDB_CACHE, md5sum)
-            with open(cache_filename, 'w') as cache_file:
-                cache_file.write(page)
-                cache_file.close()
-                log.debug('%s cached.', self.anidb_id)
-            # end
+            # The TimedLimiter only spaces requests within this process, the slot spaces them across all of them
+            with anidb_api_slot(url), metrics.timer('fetch'):
+                page = requests.get(url)
+                page = page.text
+            write_cache(self.anidb_id, page)
             if '500' in page:
                 page_copy = page.lower()
                 if 'banned' in page_copy:
                     raise plugin.PluginError('Banned from AniDB...', log)
-            soup = get_soup(page, parser="lxml")
-            # We should really check if we're banned or what...
-            if not soup:
-                log.warning('Uh oh: %s', url)
-                return
 
-        root = soup.find('anime')
+        # Keep the page around, so skipped sections can be parsed if they are asked for
+        self._page = page
+        with metrics.timer('parse'):
+            self.__parse_page()
+
+    def __parse_page(self):
+        root = self.__get_soup(self.base_tags + [self.section_tags[section] for section in self.sections])
+        # We should really check if we're banned or what...
+        if root.find(True) is None:
+            log.warning('Uh oh: %s', self)
+            return
 
         try:
             self.type = root.find('type').string
@@ -295,44 +389,14 @@ class AnidbParser(object):
 
         self.__set_dates(root.find('startdate'), root.find('enddate'))
 
-        self.__parse_tiered_tag(root.find('titles'), self.__append_title)
-
-        self.__set_sim_rel(root.find('similaranime'), root.find('related_anime'))
-
         try:
             self.official_url = root.find('url').string
         except AttributeError:
             pass
 
-        self.__parse_tiered_tag(root.find('creators'), self.__append_creator)
-
         tag_description = root.find('description')
         if tag_description is not None:
             self.description = tag_description.string
 
-        ratings_tag = root.find('ratings')
-        if ratings_tag is not None:
-            permanent_tag = ratings_tag.find('permanent')
-            mean_tag = ratings_tag.find('temporary')
-            self.ratings = {
-                'permanent': {
-                    'rating': permanent_tag.string,
-                    'votes': permanent_tag['count']
-                },
-                'mean': {
-                    'rating': mean_tag.string,
-                    'votes': mean_tag['count']
-                }
-            }
-
-        tag_root = root.find('tags')
-        if tag_root is not None:
-            self.__parse_tiered_tag(root.find('tags'), self.__append_genre)
-
-        character_root = root.find('characters')
-        if character_root is not None:
-            self.__parse_tiered_tag(root.find('characters'), self.__append_character)
-
-        episodes_root = root.find('episodes')
-        if episodes_root is not None:
-            self.__parse_tiered_tag(root.find('episodes'), self.__append_episode)
+        for section in self.sections:
+            self.__parse_section(section, root)
@@ -2,51 +2,97 @@ from __future__ import unicode_literals, division, absolute_import
 
 import hashlib
 import os
+import tempfile
 
 from flexget import logging
-from flexget.manager import manager
-from flexget.utils.soup import get_soup
+
+from .metrics import metrics
 
 log = logging.getLogger('anidb_cache')
 
 ANIDB_CACHE = '.anidb_cache'
 
+ANIDB_ANIME_STRING = 'anime: %s'
 
-def cached_anidb(func):
-    """ Decorator for loading an AniDB entry from cache """
 
-    anidb_anime_string = 'anime: %s'
+def cache_directory():
+    """ The cache directory of the running manager, looked up when needed since there is no manager at import """
+    from flexget.manager import manager
+    return os.path.join(manager.config_base, ANIDB_CACHE)
+
+
+def _blake_name(anidb_cache_name):
+    blake = hashlib.new('blake2b')
+    blake.update(anidb_cache_name)
+    return blake.hexdigest()
+
+
+def cache_path(anidb_id):
+    """ Where the page for anidb_id is cached, named by its blake2b digest, or md5 without blake2b """
+    anidb_cache_name = (ANIDB_ANIME_STRING % anidb_id).encode()
+    if 'blake2b' in hashlib.algorithms_available:
+        return os.path.join(cache_directory(), _blake_name(anidb_cache_name))
+    return os.path.join(cache_directory(), hashlib.md5(anidb_cache_name).hexdigest())
+
+
+def _read_page(file_path):
+    try:
+        with open(file_path, 'r') as cached_file:
+            return cached_file.read()
+    except (IOError, OSError):
+        return None
 
-    def __get_blake_name(anidb_cache_name):
-        blake = hashlib.new('blake2b')
-        blake.update(anidb_cache_name)
-        return blake.hexdigest()
 
-    def __get_soup(file_path):
-        if os.path.exists(file_path):
-            with open(file_path, 'r') as cached_file:
-                soup = get_soup(cached_file, parser='lxml')
-                cached_file.close()
-                return soup
+def read_cache(anidb_id):
+    """
+    The cached page for anidb_id, moving an md5 named one over to blake2b
+    :return: the page, or None if it is not cached
+    """
+    file_path = cache_path(anidb_id)
+    page = _read_page(file_path)
+    if page:
+        return page
+    md5_path = os.path.join(cache_directory(), hashlib.md5((ANIDB_ANIME_STRING % anidb_id).encode()).hexdigest())
+    if md5_path == file_path:
         return None
+    page = _read_page(md5_path)
+    if page:
+        try:
+            os.replace(md5_path, file_path)
+        except OSError:
+            # Another process moved it first, it is the same page either way
+            log.debug('%s was already moved', md5_path)
+    return page
+
+
+def write_cache(anidb_id, page):
+    """ Cache the page for anidb_id, written to a temporary file and renamed so nobody reads half a page """
+    file_path = cache_path(anidb_id)
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix='.%s-' % anidb_id)
+    try:
+        with os.fdopen(handle, 'w') as cache_file:
+            cache_file.write(page)
+        os.replace(temp_path, file_path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+    log.debug('%s cached.', anidb_id)
+
+
+def cached_anidb(func):
+    """ Decorator for loading an AniDB entry from cache, holding the anime's lock for the fetch, cache and parse """
 
     def decorator(*args, **kwargs):
         """ Logic behind the decorator """
+        from .locks import anidb_lock
         anidb_id = args[0].anidb_id
-        if anidb_id:
+        if not anidb_id:
+            metrics.count('cache_miss')
+            return func(*args, **kwargs)
+        with anidb_lock(anidb_id):
             log.trace('We have an anidb_id!')
-            anidb_cache_name = (anidb_anime_string % anidb_id).encode()
-            if 'blake2b' in hashlib.algorithms_available:
-                log.trace('blake2b is here!')
-                cache_file = os.path.join(manager.config_base, ANIDB_CACHE, __get_blake_name(anidb_cache_name))
-                kwargs.update(soup=__get_soup(cache_file))
-            if 'soup' not in kwargs or not kwargs['soup']:
-                cache_file = os.path.join(manager.config_base, ANIDB_CACHE, hashlib.md5(anidb_cache_name).hexdigest())
-                if os.path.exists(cache_file):
-                    kwargs.update(soup=__get_soup(cache_file))
-                    if 'blake2b' in hashlib.algorithms_available:
-                        blake_path = os.path.join(manager.config_base, ANIDB_CACHE, __get_blake_name(anidb_cache_name))
-                        os.rename(cache_file, blake_path)
-        func(*args, **kwargs)
+            kwargs.update(page=read_cache(anidb_id))
+            metrics.count('cache_hit' if kwargs.get('page') else 'cache_miss')
+            return func(*args, **kwargs)
 
     return decorator
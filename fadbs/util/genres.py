@@ -0,0 +1,72 @@
+""" Splitting AniDB tags into genres and tags """
+import logging
+
+log = logging.getLogger('fadbs.util.genres')
+
+
+class GenreClassifier(object):
+    """
+    Split a series' tags into genres and tags, using a map of default genres
+
+    The default genres map a tag id to:
+        True: always a genre
+        False: a genre, unless one of its overriding sub-genres is also a genre
+        another tag id: a genre that replaces that genre, and whatever that genre replaces in turn
+
+    Any tag at or above the weight threshold is a genre too. A genre whose ancestors include an overriding sub-genre
+    replaces the same genres that sub-genre would. Replaced genres are demoted to tags.
+    """
+
+    def __init__(self, default_genres):
+        self.default_genres = default_genres
+        self.replaces = self.__resolve_overrides(default_genres)
+
+    @staticmethod
+    def __is_override(value):
+        return isinstance(value, int) and not isinstance(value, bool)
+
+    @classmethod
+    def __resolve_overrides(cls, default_genres):
+        """ For every overriding genre, every genre it ends up replacing, following chains of overrides """
+        replaces = {}
+        for tag_id, target in default_genres.items():
+            replaced = []
+            while cls.__is_override(target) and target != tag_id and target not in replaced:
+                replaced.append(target)
+                target = default_genres.get(target)
+            if replaced:
+                replaces[tag_id] = frozenset(replaced)
+        return replaces
+
+    def __replaced_by(self, tag_id, lineage):
+        if tag_id in self.replaces:
+            return self.replaces[tag_id]
+        for ancestor in lineage:
+            if ancestor in self.replaces:
+                return self.replaces[ancestor]
+        return frozenset()
+
+    def classify(self, tags, lineage, genre_weight):
+        """
+        Split tags into genres and tags
+        :param tags: dict of tag id to [name, weight], like anidb_tags
+        :param lineage: dict of tag id to its ancestors' ids, closest first, like anidb_tag_lineage
+        :param genre_weight: tags weighing at least this much are genres
+        :return: tuple of genre names and tag names
+        """
+        genres = set()
+        replaced = set()
+        for tag_id, (_, weight) in tags.items():
+            if tag_id in self.default_genres or weight >= genre_weight:
+                genres.add(tag_id)
+                replaced.update(self.__replaced_by(tag_id, lineage.get(tag_id, ())))
+        genre_names = []
+        tag_names = []
+        for tag_id, (name, _) in tags.items():
+            if tag_id in genres and tag_id not in replaced:
+                genre_names.append(name)
+                continue
+            if tag_id in replaced:
+                log.trace('%s (%s) is replaced by one of its sub-genres, making it a tag', name, tag_id)
+            tag_names.append(name)
+        return genre_names, tag_names
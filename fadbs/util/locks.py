@@ -0,0 +1,155 @@
+""" Per anime file locks, so parallel FlexGet processes fetch and store each anime once instead of racing """
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from .metrics import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+log = logging.getLogger('fadbs.util.locks')
+
+LOCK_DIRECTORY = 'locks'
+
+# How long to wait for another process before giving up, a fetch is rate limited to one every 2 seconds
+LOCK_TIMEOUT = 120
+
+# AniDB's HTTP API allows one request every 2 seconds per client, and every process on this machine is the same client
+ANIDB_API_HOST = 'api.anidb.net'
+ANIDB_API_INTERVAL = 2.0
+POLL_INTERVAL = 0.05
+
+
+class LockTimeout(Exception):
+    """ Another process held the lock for longer than the timeout """
+
+
+# Locks the threads of this process hold, so a thread can take the same lock again, e.g. in lookup and then parse
+_held = {}
+_held_guard = threading.Lock()
+
+
+def _try_lock(lock_file):
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _unlock(lock_file):
+    if fcntl is not None:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    else:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def file_lock(path, timeout=LOCK_TIMEOUT):
+    """
+    Hold an exclusive lock on path, shared with other processes and with other threads of this one
+    :param path: the lock file, created if it is not there. It is never removed, an unlocked file costs nothing.
+    :param timeout: seconds to wait for it
+    :raises LockTimeout: if it could not be had in time
+    """
+    key = (path, threading.current_thread().ident)
+    with _held_guard:
+        reentered = key in _held
+    if reentered:
+        # Only the outermost holder unlocks
+        yield
+        return
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    lock_file = open(path, 'a+')
+    try:
+        started = time.time()
+        waited = False
+        while not _try_lock(lock_file):
+            if not waited:
+                log.debug('Waiting for another process to release %s', path)
+                waited = True
+            if time.time() - started >= timeout:
+                raise LockTimeout('%s was locked for more than %s seconds' % (path, timeout))
+            time.sleep(POLL_INTERVAL)
+        if waited:
+            metrics.observe('lock_wait', time.time() - started)
+        with _held_guard:
+            _held[key] = lock_file
+        try:
+            yield
+        finally:
+            with _held_guard:
+                del _held[key]
+            _unlock(lock_file)
+    finally:
+        lock_file.close()
+
+
+def anidb_lock(anidb_id, timeout=LOCK_TIMEOUT):
+    """ The lock for one anime, taken around fetching, caching, parsing and storing it """
+    from .anidb_cache import cache_directory
+    return file_lock(os.path.join(cache_directory(), LOCK_DIRECTORY, '%s.lock' % anidb_id), timeout=timeout)
+
+
+def snapshot_lock(timeout=LOCK_TIMEOUT):
+    """ The lock for reading, merging and replacing the snapshot, so one process does not undo another's update """
+    from .anidb_cache import cache_directory
+    return file_lock(os.path.join(cache_directory(), LOCK_DIRECTORY, 'snapshot.lock'), timeout=timeout)
+
+
+@contextmanager
+def request_slot(name, interval, timeout=LOCK_TIMEOUT):
+    """
+    Space requests at least interval seconds apart across every process sharing the cache directory.
+    The request is made inside the with block, one process at a time, and the time it finished is written down.
+    :param name: what is being rate limited, it names the lock file
+    :param interval: seconds between the end of one request and the start of the next
+    """
+    from .anidb_cache import cache_directory
+    path = os.path.join(cache_directory(), LOCK_DIRECTORY, '%s.lock' % name)
+    stamp_path = path + '.last'
+    with file_lock(path, timeout=timeout):
+        try:
+            with open(stamp_path, 'r') as stamp:
+                last = float(stamp.read().strip() or 0)
+        except (IOError, OSError, ValueError):
+            last = 0.0
+        wait = last + interval - time.time()
+        if wait > 0:
+            metrics.observe('rate_limit_wait', min(wait, interval))
+            # min, so a clock that jumped back does not stall every process
+            time.sleep(min(wait, interval))
+        try:
+            yield
+        finally:
+            with open(stamp_path, 'w') as stamp:
+                stamp.write('%f' % time.time())
+
+
+@contextmanager
+def anidb_api_slot(url):
+    """ The slot for one request to url, only requests to AniDB's HTTP API wait for one, like the TimedLimiter """
+    if urlparse(url).hostname != ANIDB_API_HOST:
+        yield
+        return
+    with request_slot('anidb_api', ANIDB_API_INTERVAL):
+        yield
@@ -0,0 +1,112 @@
+""" Timers and counters for the expensive parts of FADBS """
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+
+class Metrics(object):
+    """ A registry of named timers and counters, safe to use from the nfo writer threads """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+
+    def reset(self):
+        with self._lock:
+            self.timers = {}
+            self.counters = {}
+
+    def count(self, name, amount=1):
+        """ Add amount to the counter called name """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        """ Record one run of the timer called name that took seconds """
+        with self._lock:
+            timer = self.timers.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+            timer['count'] += 1
+            timer['total'] += seconds
+            timer['max'] = max(timer['max'], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """ Time the body of a with block """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started)
+
+    def timed(self, name):
+        """ Decorator, time every call of the function """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        """ A copy of everything recorded so far """
+        with self._lock:
+            return {
+                'timers': dict((name, dict(timer)) for name, timer in self.timers.items()),
+                'counters': dict(self.counters)
+            }
+
+    def summary(self):
+        """ One line per timer and counter, for the log """
+        snapshot = self.snapshot()
+        lines = []
+        for name, timer in sorted(snapshot['timers'].items()):
+            average = timer['total'] / timer['count'] if timer['count'] else 0.0
+            lines.append('%s: %s calls, %.3fs total, %.1fms average, %.1fms max' % (
+                name, timer['count'], timer['total'], average * 1000, timer['max'] * 1000))
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('%s: %s' % (name, value))
+        return lines
+
+    def to_json(self, **extra):
+        """ Everything recorded, plus any extra keys, as JSON """
+        snapshot = self.snapshot()
+        snapshot.update(extra)
+        return json.dumps(snapshot, indent=2, sort_keys=True)
+
+    def to_prometheus(self, prefix='fadbs', labels=None):
+        """ Everything recorded in the Prometheus text exposition format """
+        snapshot = self.snapshot()
+        label_text = ''
+        if labels:
+            label_text = '{%s}' % ','.join('%s="%s"' % (key, self.__escape_label(value))
+                                           for key, value in sorted(labels.items()))
+        lines = []
+        for name, timer in sorted(snapshot['timers'].items()):
+            metric = '%s_%s_seconds' % (prefix, self.__metric_name(name))
+            lines.append('# TYPE %s summary' % metric)
+            lines.append('%s_count%s %s' % (metric, label_text, timer['count']))
+            lines.append('%s_sum%s %r' % (metric, label_text, timer['total']))
+            lines.append('# TYPE %s_max gauge' % metric)
+            lines.append('%s_max%s %r' % (metric, label_text, timer['max']))
+        for name, value in sorted(snapshot['counters'].items()):
+            metric = '%s_%s_total' % (prefix, self.__metric_name(name))
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s%s %s' % (metric, label_text, value))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def __metric_name(name):
+        return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+    @staticmethod
+    def __escape_label(value):
+        return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+# Shared by every FADBS plugin, reset by fadbs_metrics at the start of each task
+metrics = Metrics()
@@ -0,0 +1,105 @@
+""" Normalizing release and series names, so the same series always ends up with the same key """
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+PARTICLE_WORDS = {
+    'x-jat': {
+        'no', 'wo', 'o', 'na', 'ja', 'ni', 'to', 'ga', 'wa'
+    }
+}
+
+# Particles that get romanized more than one way, mapped to one spelling
+PARTICLE_ALIASES = {
+    'x-jat': {
+        'wo': 'o'
+    }
+}
+
+# Things release groups put around the series name, none of which are part of it
+BRACKETED_REGEX = re.compile(r'[\[{【][^\]}】]*[\]}】]')
+EXTENSION_REGEX = re.compile(r'\.(mkv|mp4|avi|m4v|webm|ogm|wmv|ts)$', re.IGNORECASE)
+METADATA_PARENS_REGEX = re.compile(r'\((?:[^)]*\b(?:\d{3,4}p|x26[45]|h\.?26[45]|hevc|avc|bd|web|dvd|aac|flac)\b'
+                                   r'[^)]*)\)', re.IGNORECASE)
+RESOLUTION_REGEX = re.compile(r'\b(?:\d{3,4}p|\d{3,4}x\d{3,4}|4k|uhd)\b', re.IGNORECASE)
+CODEC_REGEX = re.compile(r'\b(?:x26[45]|h\.?26[45]|hevc|avc|hi10p?|10-?bit|8-?bit|aac|flac|ac3|opus|dts|'
+                         r'bd(?:rip)?|blu-?ray|web-?(?:dl|rip)?|dvd(?:rip)?|hdtv|dual[ .-]audio|multi[ .-]?subs?)\b',
+                         re.IGNORECASE)
+GROUP_REGEX = re.compile(r'^\s*[\[【]([^\]】]+)[\]】]')
+# A bare trailing number is not an episode, "Mob Psycho 100" is a series. It takes a dash or a marker.
+EPISODE_REGEX = re.compile(r'(?:\s[-–]\s*(?P<dash>\d{1,4}(?:\.\d)?)'
+                           r'|\bs(?P<season>\d{1,2})e(?P<season_episode>\d{1,4})'
+                           r'|(?:\b(?:ep|episode|e)|#)\.?\s*(?P<marked>\d{1,4}))'
+                           r'(?:v(?P<version>\d))?\b', re.IGNORECASE)
+VERSION_REGEX = re.compile(r'\bv\d\b', re.IGNORECASE)
+
+
+def _slugify(text):
+    """ python-slugify, imported the first time it is needed """
+    from slugify import slugify
+    return slugify(text)
+
+
+def particle_search_terms(name, language='x-jat'):
+    """
+    Split a name into search terms, with particles marked optional for anisearch
+    :param name: name to search for
+    :param language: which language's particles to look out for
+    :return: list of terms
+    """
+    return ['~' + part if part in PARTICLE_WORDS[language] else part for part in _slugify(name).split('-')]
+
+
+ReleaseName = namedtuple('ReleaseName', ['series', 'episode', 'season', 'version', 'group', 'resolution'])
+
+
+@lru_cache(maxsize=4096)
+def parse_release(name):
+    """
+    Split a release or file name into its parts, without any searching
+    :param name: release or file name, e.g. [Group] Series Name - 05v2 [1080p].mkv
+    :return: ReleaseName, with None for the parts that are not there
+    """
+    name = name.strip()
+    group = GROUP_REGEX.match(name)
+    resolution = RESOLUTION_REGEX.search(name.replace('_', ' '))
+    remaining = EXTENSION_REGEX.sub('', name).replace('_', ' ')
+    remaining = BRACKETED_REGEX.sub(' ', remaining)
+    remaining = METADATA_PARENS_REGEX.sub(' ', remaining)
+    episode = EPISODE_REGEX.search(remaining)
+    if episode is not None:
+        remaining = remaining[:episode.start()]
+    for regex in (RESOLUTION_REGEX, CODEC_REGEX, VERSION_REGEX):
+        remaining = regex.sub(' ', remaining)
+    series = ' '.join(remaining.split()).strip(' -.')
+    episode_number = season = version = None
+    if episode is not None:
+        episode_number = episode.group('dash') or episode.group('season_episode') or episode.group('marked')
+        episode_number = float(episode_number) if '.' in episode_number else int(episode_number)
+        season = int(episode.group('season')) if episode.group('season') else None
+        version = int(episode.group('version')) if episode.group('version') else None
+    return ReleaseName(series=series or None, episode=episode_number, season=season, version=version,
+                       group=group.group(1).strip() if group else None,
+                       resolution=resolution.group().lower() if resolution else None)
+
+
+def strip_release(name):
+    """
+    Strip a release name down to what might be the series name
+    :param name: release or file name
+    :return: name without group tags, resolution, codecs, episode markers or extension
+    """
+    return parse_release(name).series or ''
+
+
+@lru_cache(maxsize=4096)
+def normalize_name(name, language='x-jat'):
+    """
+    A key for name that is the same for every way a release might spell it
+    :param name: release, file or series name
+    :param language: which language's particle spellings to unify
+    :return: lower case, dash separated key, empty if nothing is left
+    """
+    aliases = PARTICLE_ALIASES.get(language, {})
+    parts = _slugify(strip_release(name)).split('-')
+    return '-'.join(aliases.get(part, part) for part in parts if part)
@@ -0,0 +1,172 @@
+""" Writing nfo files without touching the ones that did not change """
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger('fadbs.util.nfo_writer')
+
+
+class NfoWriter(object):
+    """
+    Write rendered nfo files, skipping files whose content on disk is already identical
+
+    With more than one worker, files handed to submit are written on a thread pool. On network storage most of the
+    time goes to waiting on open/write/close, so a handful of threads hides most of it.
+    """
+
+    # How much of an existing file to read at once when hashing it
+    chunk_size = 64 * 1024
+
+    # How many files per worker may be rendered and waiting, so a big library is not held in memory all at once
+    queue_per_worker = 4
+
+    def __init__(self, max_workers=1):
+        self.stats = {'rendered': 0, 'written': 0, 'skipped': 0, 'failed': 0}
+        self.timings = {'total': 0.0, 'io': 0.0, 'slowest': 0.0}
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._executor = None
+        self._slots = None
+        if max_workers > 1:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers)
+            self._slots = threading.BoundedSemaphore(max_workers * self.queue_per_worker)
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    @staticmethod
+    def _new_hash():
+        if 'blake2b' in hashlib.algorithms_available:
+            return hashlib.new('blake2b')
+        return hashlib.md5()
+
+    def digest(self, content):
+        """
+        Hash some rendered content
+        :param content: the bytes that would be written
+        :return: hex digest of content
+        """
+        content_hash = self._new_hash()
+        content_hash.update(content)
+        return content_hash.hexdigest()
+
+    def file_digest(self, path):
+        """
+        Hash a file on disk
+        :param path: path to the file
+        :return: hex digest of the file, or None if the file does not exist
+        """
+        content_hash = self._new_hash()
+        try:
+            with open(path, 'rb') as existing:
+                for chunk in iter(lambda: existing.read(self.chunk_size), b''):
+                    content_hash.update(chunk)
+        except (IOError, OSError):
+            return None
+        return content_hash.hexdigest()
+
+    def write(self, path, content):
+        """
+        Write content to path, unless path already has exactly that content
+        :param path: path of the nfo file
+        :param content: rendered nfo, as text
+        :return: True if the file was written, False if it was skipped
+        """
+        data = content.encode('utf-8')
+        self._count('rendered')
+        started = time.time()
+        try:
+            if self.unchanged(path, data):
+                log.trace('%s is unchanged, skipping', path)
+                self._count('skipped')
+                return False
+            self._replace(path, data)
+            self._count('written')
+            return True
+        finally:
+            elapsed = time.time() - started
+            with self._lock:
+                self.timings['io'] += elapsed
+                self.timings['slowest'] = max(self.timings['slowest'], elapsed)
+
+    def _write_isolated(self, path, content, callback=None):
+        """ Write one file, a failure is logged and counted instead of stopping the others """
+        try:
+            self.write(path, content)
+        except (IOError, OSError) as error:
+            log.error('Unable to write %s: %s', path, error)
+            self._count('failed')
+            return
+        if callback is not None:
+            callback(path)
+
+    def submit(self, path, content, callback=None):
+        """
+        Queue content to be written to path, see write. Errors are logged and counted in stats['failed'].
+        Blocks while the queue is full.
+
+        :param callback: called with path once path holds content, from the worker thread
+        """
+        if self._executor is None:
+            self._write_isolated(path, content, callback)
+            return
+        self._slots.acquire()
+        future = self._executor.submit(self._write_isolated, path, content, callback)
+        future.add_done_callback(lambda _: self._slots.release())
+
+    def close(self):
+        """ Wait for every submitted file to be written """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.timings['total'] = time.time() - self._started
+
+    def unchanged(self, path, data):
+        """ Check if path already holds data, without reading it when the size alone says it differs """
+        try:
+            if os.path.getsize(path) != len(data):
+                return False
+        except OSError:
+            return False
+        return self.file_digest(path) == self.digest(data)
+
+    @staticmethod
+    def _replace(path, data):
+        """ Write to a temporary file next to path, then move it over path so readers never see half a file """
+        directory = os.path.dirname(path) or '.'
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except OSError:
+            mode = None
+        # Not mkstemp, its files are 0600. Created with 0666 the umask applies, like it would to any new file.
+        temp_path = os.path.join(directory, '.%s.tmp' % uuid.uuid4().hex)
+        temp_fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+        try:
+            with os.fdopen(temp_fd, 'wb') as temp_file:
+                temp_file.write(data)
+            if mode is not None:
+                os.chmod(temp_path, mode)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        log.debug('Wrote %s', path)
+
+    def summary(self):
+        summary = 'rendered %(rendered)s, written %(written)s, skipped %(skipped)s, failed %(failed)s' % self.stats
+        files = self.stats['written'] + self.stats['skipped']
+        average = self.timings['io'] / files if files else 0.0
+        return '%s in %.2fs (%.1fms per file, slowest %.1fms)' % (summary, self.timings['total'], average * 1000,
+                                                                  self.timings['slowest'] * 1000)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,108 @@
+""" Full text search over the local AniDB data, with SQLite's FTS5 """
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from .metrics import metrics
+
+log = logging.getLogger('fadbs.util.search_index')
+
+
+class AnimeSearchIndex(object):
+    """
+    An FTS5 table over titles, episode titles, descriptions and tags, one row per anime with the AniDB id as its rowid.
+
+    Databases that are not SQLite, or SQLite built without FTS5, fall back to a LIKE over the titles.
+    """
+
+    table = 'anidb_fts'
+
+    # Column weights for ranking, a title match counts for much more than one in a description
+    weights = {
+        'titles': 10.0,
+        'episode_titles': 2.0,
+        'description': 1.0,
+        'tags': 4.0
+    }
+
+    columns = ('titles', 'episode_titles', 'description', 'tags')
+
+    create_sql = ("CREATE VIRTUAL TABLE IF NOT EXISTS anidb_fts USING fts5("
+                  "titles, episode_titles, description, tags, tokenize='unicode61 remove_diacritics 2')")
+
+    def __init__(self):
+        self._available = {}
+
+    def available(self, session):
+        """ Whether FTS5 can be used with this session's database, creating the table the first time """
+        bind = session.get_bind()
+        key = str(bind.url)
+        if key not in self._available:
+            self._available[key] = False
+            if bind.dialect.name == 'sqlite':
+                try:
+                    with session.begin_nested():
+                        session.execute(text(self.create_sql))
+                    self._available[key] = True
+                except OperationalError as error:
+                    log.warning('SQLite has no FTS5 (%s), searching titles only', error)
+        return self._available[key]
+
+    def update(self, session, anidb_id, titles=(), episode_titles=(), description=None, tags=()):
+        """ Replace what is indexed for one anime """
+        if not self.available(session):
+            return
+        with metrics.timer('fts_update'):
+            session.execute(text('DELETE FROM anidb_fts WHERE rowid = :anidb_id'), {'anidb_id': anidb_id})
+            session.execute(text('INSERT INTO anidb_fts (rowid, titles, episode_titles, description, tags) '
+                                 'VALUES (:anidb_id, :titles, :episode_titles, :description, :tags)'), {
+                                     'anidb_id': anidb_id,
+                                     'titles': '\n'.join(title for title in titles if title),
+                                     'episode_titles': '\n'.join(title for title in episode_titles if title),
+                                     'description': description or '',
+                                     'tags': '\n'.join(tag for tag in tags if tag)
+                                 })
+
+    def clear(self, session):
+        if self.available(session):
+            session.execute(text('DELETE FROM anidb_fts'))
+
+    @staticmethod
+    def match_expression(query):
+        """ Quote every word, so punctuation like Re:Zero is not read as FTS syntax, and prefix match the last """
+        terms = ['"%s"' % term.replace('"', '""') for term in query.split()]
+        if terms:
+            terms[-1] += '*'
+        return ' '.join(terms)
+
+    def search(self, session, query, limit=20, raw=False):
+        """
+        Find anime matching query, best first
+        :param query: words to look for
+        :param limit: most results to return
+        :param raw: query is an FTS5 expression, e.g. 'titles: gundam NOT tags: comedy'
+        :return: list of AniDB id and rank, lower ranks are better
+        """
+        if not query.strip():
+            return []
+        with metrics.timer('fts_search'):
+            if not self.available(session):
+                return self.__search_titles(session, query, limit)
+            weights = ', '.join(str(self.weights[column]) for column in self.columns)
+            rows = session.execute(text('SELECT rowid, bm25(anidb_fts, %s) AS rank FROM anidb_fts '
+                                        'WHERE anidb_fts MATCH :query ORDER BY rank LIMIT :limit' % weights),
+                                   {'query': query if raw else self.match_expression(query), 'limit': limit})
+            return [(row[0], row[1]) for row in rows]
+
+    @staticmethod
+    def __search_titles(session, query, limit):
+        rows = session.execute(text('SELECT DISTINCT anidb_series.anidb_id FROM anidb_titles '
+                                    'JOIN anidb_series ON anidb_titles.parent_id = anidb_series.id '
+                                    'WHERE lower(anidb_titles.name) LIKE :query LIMIT :limit'),
+                               {'query': '%%%s%%' % query.lower(), 'limit': limit})
+        return [(row[0], 0.0) for row in rows]
+
+
+# One per process, it only remembers which databases have FTS5
+search_index = AnimeSearchIndex()
@@ -0,0 +1,225 @@
+"""
+A compact snapshot of the anime in the database, memory mapped so a short run can look things up without the database
+
+Layout, little endian:
+    header   magic, version, anime count, title count, offset of the title index
+    anime    (anidb id, offset, length) per anime, sorted by anidb id
+    titles   (key offset, key length, anidb id) per title, sorted by key
+    data     a JSON record per anime, then the title keys, both utf-8
+
+Only the fixed size indexes are searched, and only the records that are asked for are decoded.
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+
+log = logging.getLogger('fadbs.util.snapshot')
+
+SNAPSHOT_FILE = 'fadbs_snapshot.bin'
+
+MAGIC = b'FADBSNAP'
+VERSION = 1
+
+HEADER = struct.Struct('<8sIIII')
+ANIME_ENTRY = struct.Struct('<III')
+TITLE_ENTRY = struct.Struct('<III')
+
+
+def title_key(title):
+    """ What titles are matched on, case and spacing do not matter """
+    return ' '.join(title.lower().split())
+
+
+class CatalogSnapshot(object):
+    """ A read only, memory mapped snapshot. Build one with write. """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as snapshot_file:
+            self.mtime = os.fstat(snapshot_file.fileno()).st_mtime
+            self._map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.anime_count, self.title_count, self._titles_offset = \
+                HEADER.unpack_from(self._map, 0)
+        except struct.error:
+            self.close()
+            raise ValueError('%s is too short to be a snapshot' % path)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError('%s is not a version %s snapshot' % (path, VERSION))
+
+    def __len__(self):
+        return self.anime_count
+
+    def __contains__(self, anidb_id):
+        return self.__find_anime(anidb_id) is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._map.close()
+
+    def __find_anime(self, anidb_id):
+        low, high = 0, self.anime_count
+        while low < high:
+            middle = (low + high) // 2
+            entry = ANIME_ENTRY.unpack_from(self._map, HEADER.size + middle * ANIME_ENTRY.size)
+            if entry[0] < anidb_id:
+                low = middle + 1
+            elif entry[0] > anidb_id:
+                high = middle
+            else:
+                return entry
+        return None
+
+    def get(self, anidb_id):
+        """
+        The snapshot record of an anime
+        :return: dict with titles, tags and episodes, or None if it is not in the snapshot
+        """
+        entry = self.__find_anime(anidb_id)
+        if entry is None:
+            return None
+        _, offset, length = entry
+        return json.loads(self._map[offset:offset + length].decode('utf-8'))
+
+    def find_title(self, title):
+        """
+        :param title: any title of the anime, in any case
+        :return: AniDB id, or None if no anime has that title
+        """
+        key = title_key(title).encode('utf-8')
+        low, high = 0, self.title_count
+        while low < high:
+            middle = (low + high) // 2
+            key_offset, key_length, anidb_id = TITLE_ENTRY.unpack_from(
+                self._map, self._titles_offset + middle * TITLE_ENTRY.size)
+            candidate = self._map[key_offset:key_offset + key_length]
+            if candidate < key:
+                low = middle + 1
+            elif candidate > key:
+                high = middle
+            else:
+                return anidb_id
+        return None
+
+    def _raw_records(self):
+        """ AniDB id and encoded record of every anime, without decoding them """
+        for position in range(self.anime_count):
+            anidb_id, offset, length = ANIME_ENTRY.unpack_from(self._map, HEADER.size + position * ANIME_ENTRY.size)
+            yield anidb_id, self._map[offset:offset + length]
+
+    def _raw_titles(self):
+        """ Encoded title key and AniDB id of every title """
+        for position in range(self.title_count):
+            key_offset, key_length, anidb_id = TITLE_ENTRY.unpack_from(
+                self._map, self._titles_offset + position * TITLE_ENTRY.size)
+            yield self._map[key_offset:key_offset + key_length], anidb_id
+
+    @staticmethod
+    def _add_records(blobs, titles, records):
+        for anidb_id, record in records:
+            blobs[anidb_id] = json.dumps(record, separators=(',', ':')).encode('utf-8')
+            for title in record.get('titles', ()):
+                # A title shared by several anime goes to the lowest id, that is usually the original
+                key = title_key(title[0]).encode('utf-8')
+                if anidb_id < titles.get(key, anidb_id + 1):
+                    titles[key] = anidb_id
+
+    @staticmethod
+    def write(path, records):
+        """
+        Write a snapshot, replacing the old one only once it is complete
+        :param path: where to write it
+        :param records: iterable of (anidb id, dict of titles, tags and episodes)
+        :return: how many anime were written
+        """
+        blobs = {}
+        titles = {}
+        CatalogSnapshot._add_records(blobs, titles, records)
+        return CatalogSnapshot._write(path, blobs, titles)
+
+    @staticmethod
+    def update(path, records):
+        """
+        Replace the records of some anime, copying the rest over from the snapshot at path without decoding them.
+        A title an updated anime no longer has is gone until the next full write, even if another anime has it too.
+        :param records: list of (anidb id, dict of titles, tags and episodes)
+        :return: how many anime the snapshot has now
+        """
+        records = list(records)
+        changed = set(anidb_id for anidb_id, _ in records)
+        blobs = {}
+        titles = {}
+        try:
+            old = CatalogSnapshot(path)
+        except (OSError, IOError, ValueError) as error:
+            log.debug('Starting a new snapshot: %s', error)
+        else:
+            with old:
+                blobs.update((anidb_id, blob) for anidb_id, blob in old._raw_records() if anidb_id not in changed)
+                titles.update((key, anidb_id) for key, anidb_id in old._raw_titles() if anidb_id not in changed)
+        CatalogSnapshot._add_records(blobs, titles, records)
+        return CatalogSnapshot._write(path, blobs, titles)
+
+    @staticmethod
+    def _write(path, blobs, titles):
+        anime_ids = sorted(blobs)
+        title_keys = sorted(titles)
+        titles_offset = HEADER.size + len(anime_ids) * ANIME_ENTRY.size
+        offset = titles_offset + len(title_keys) * TITLE_ENTRY.size
+
+        index = [HEADER.pack(MAGIC, VERSION, len(anime_ids), len(title_keys), titles_offset)]
+        for anidb_id in anime_ids:
+            index.append(ANIME_ENTRY.pack(anidb_id, offset, len(blobs[anidb_id])))
+            offset += len(blobs[anidb_id])
+        for key in title_keys:
+            index.append(TITLE_ENTRY.pack(offset, len(key), titles[key]))
+            offset += len(key)
+
+        directory = os.path.dirname(path) or '.'
+        handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.snapshot-')
+        try:
+            with os.fdopen(handle, 'wb') as snapshot_file:
+                snapshot_file.write(b''.join(index))
+                for anidb_id in anime_ids:
+                    snapshot_file.write(blobs[anidb_id])
+                snapshot_file.write(b''.join(title_keys))
+            os.replace(temp_path, path)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+        log.debug('Wrote a snapshot of %s anime and %s titles to %s', len(anime_ids), len(title_keys), path)
+        return len(anime_ids)
+
+
+_loaded = {}
+
+
+def load_snapshot(path):
+    """
+    The snapshot at path, mapped once per process and mapped again when it is rebuilt
+    :return: CatalogSnapshot, or None if there is no usable snapshot
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    snapshot = _loaded.get(path)
+    if snapshot is not None and snapshot.mtime == mtime:
+        return snapshot
+    try:
+        fresh = CatalogSnapshot(path)
+    except (OSError, ValueError) as error:
+        log.warning('Ignoring the snapshot: %s', error)
+        return None
+    _loaded[path] = fresh
+    # The old mapping is left for the garbage collector, a record from it might still be in use
+    return fresh
@@ -15,3 +15,15 @@ def find_in_list_of_dict(haystack, test_key, test_value, needle_key, return_firs
     if return_first:
         return results[0]
     return results
+
+
+def chunks(items, size):
+    """
+    Split items into lists of at most size items, e.g. to keep SQL IN clauses under the variable limit
+    :param items: any iterable
+    :param size: largest chunk to yield
+    :return: generator of lists
+    """
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
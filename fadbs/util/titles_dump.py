@@ -0,0 +1,41 @@
+""" Stream AniDB's anime-titles.xml(.gz) dump, one anime at a time, without ever holding the whole tree """
+import gzip
+import logging
+from xml.etree.ElementTree import iterparse
+
+log = logging.getLogger('fadbs.util.titles_dump')
+
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+
+def open_dump(path):
+    """ The dump as a binary stream, decompressed on the fly if it is gzipped """
+    with open(path, 'rb') as dump:
+        gzipped = dump.read(2) == b'\x1f\x8b'
+    return gzip.open(path, 'rb') if gzipped else open(path, 'rb')
+
+
+def iter_titles_dump(path):
+    """
+    Read anime from an anime-titles dump
+    :param path: anime-titles.xml.gz or anime-titles.xml, as downloaded from AniDB
+    :return: generator of AniDB id and list of title dicts, with name, lang and type like AnidbParser.titles
+    """
+    with open_dump(path) as dump:
+        root = None
+        for event, element in iterparse(dump, events=('start', 'end')):
+            if root is None:
+                root = element
+                continue
+            if event != 'end' or element.tag != 'anime':
+                continue
+            try:
+                anidb_id = int(element.get('aid'))
+            except (TypeError, ValueError):
+                log.debug('Skipping an anime without a usable aid: %s', element.get('aid'))
+            else:
+                titles = [{'name': title.text.strip(), 'lang': title.get(XML_LANG), 'type': title.get('type')}
+                          for title in element.iter('title') if title.text and title.text.strip()]
+                yield anidb_id, titles
+            # Everything that was read so far hangs off the root, let it go
+            root.clear()